@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import datetime
+import functools
+import glob
+import http.server
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+# Benchmarks reprodutíveis das etapas da pipeline sobre dados sintéticos no formato do Comex Stat.
+# Cada medição roda em um processo filho (fork), para isolar o tempo e o pico de memória
+benchmarks_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(benchmarks_dir, os.pardir, 'scripts'))
+
+import synthetic_data
+import catalog
+import fetch_data
+import http_cache
+import join_aux_data
+import generate_ipvs
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def measure(function, trace=False):
+    # Executa a função em um processo filho e devolve duração, RSS (inicial e pico) e, opcionalmente,
+    # o pico de memória rastreado pelo tracemalloc (que deixa o código Python mais lento)
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+
+    def target():
+        baseline = peak_rss_bytes()
+        if trace:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        rows = function()
+        seconds = time.perf_counter() - start_time
+        result = {'seconds': round(seconds, 4), 'rows': rows, 'baseline_rss_bytes': baseline, 'peak_rss_bytes': peak_rss_bytes()}
+        if trace:
+            result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+        if rows:
+            result['rows_per_second'] = round(rows / seconds, 1)
+        queue.put(result)
+
+    process = context.Process(target=target)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def start_file_server(directory):
+    # Servidor HTTP local que serve os arquivos sintéticos (com Last-Modified, como o servidor real)
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+def bench_download(base_url, years, data_type, rows):
+    async def run():
+        semaphore = asyncio.Semaphore(fetch_data.DEFAULT_CONCURRENCY)
+        async with fetch_data.create_session() as session:
+            await fetch_data.download_and_filter_data(session, semaphore, [str(year) for year in years], fetch_data.NCM_CODES, data_type, base_url)
+    asyncio.run(run())
+    return rows * len(years)
+
+def bench_merge(raw_path, processed_path, aux_dir):
+    join_aux_data.merge_auxiliary_tables(raw_path, processed_path, aux_dir)
+    return sum(1 for _ in open(raw_path)) - 1
+
+def bench_series(processed_path, series_dir, prefix):
+    data_df = pd.read_csv(processed_path)
+    series_df = catalog.load_series('country_series')
+    generate_ipvs.process_and_save_data(series_df, data_df, series_dir, prefix, catalog.series_column('country_series'), 'country_series')
+    return len(data_df)
+
+def bench_consolidate(series_dir):
+    files = len(glob.glob(os.path.join(series_dir, '???_*.ipv')))
+    generate_ipvs.consolidate_ipvs(series_dir, 'country_series')
+    return files
+
+def bench_wo_rows(file_path):
+    generate_ipvs.generate_wo_rows(file_path)
+    return sum(1 for _ in open(file_path)) - 1
+
+def run_scale(workdir, rows, years, trace=False):
+    print(f"Gerando dados sintéticos: {rows} linhas por arquivo, anos {years}")
+    server_dir, aux_dir = synthetic_data.generate_dataset(workdir, rows, years)
+    # As etapas usam caminhos relativos (data/raw, data/ipvs) e o cache HTTP do módulo
+    os.chdir(workdir)
+    os.makedirs(os.path.join('data', 'raw'), exist_ok=True)
+    os.makedirs(os.path.join('data', 'processed'), exist_ok=True)
+    series_dir = os.path.join(workdir, 'data', 'ipvs', 'country_series')
+    os.makedirs(series_dir, exist_ok=True)
+    os.makedirs(os.path.join('data', 'logs'), exist_ok=True)
+    generate_ipvs.configure_logging()
+    http_cache.cache_dir = os.path.join(workdir, 'cache', 'http')
+    http_cache.index_path = os.path.join(http_cache.cache_dir, 'index.json')
+    server, base_url = start_file_server(server_dir)
+    results = {}
+    try:
+        for data_type in ('EXP', 'IMP'):
+            results[f'download_and_filter_data[{data_type}]'] = measure(lambda: bench_download(base_url, years, data_type, rows), trace)
+        for data_type in ('EXP', 'IMP'):
+            raw_path = os.path.join('data', 'raw', f'{data_type}_final.csv')
+            processed_path = os.path.join('data', 'processed', f'{data_type}_final_processed.csv')
+            results[f'merge_auxiliary_tables[{data_type}]'] = measure(lambda: bench_merge(raw_path, processed_path, aux_dir), trace)
+        for data_type in ('EXP', 'IMP'):
+            processed_path = os.path.join('data', 'processed', f'{data_type}_final_processed.csv')
+            results[f'process_and_save_data[{data_type}]'] = measure(lambda: bench_series(processed_path, series_dir, data_type), trace)
+        results['consolidate_ipvs'] = measure(lambda: bench_consolidate(series_dir), trace)
+        export_filename, import_filename = generate_ipvs.consolidated_filenames(series_dir, 'country_series')
+        results['generate_wo_rows[EXP]'] = measure(lambda: bench_wo_rows(export_filename), trace)
+        results['generate_wo_rows[IMP]'] = measure(lambda: bench_wo_rows(import_filename), trace)
+    finally:
+        server.shutdown()
+    return results
+
+def print_results(rows, results):
+    print(f"\nResultados para {rows} linhas por arquivo:")
+    print(f"{'benchmark':<36}{'segundos':>10}{'linhas/s':>14}{'pico RSS (MB)':>16}")
+    for name, result in results.items():
+        print(f"{name:<36}{result['seconds']:>10.3f}{result.get('rows_per_second', 0):>14.0f}{result['peak_rss_bytes'] / 2**20:>16.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks da pipeline COMEX com dados sintéticos.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000], help="Escalas (linhas por arquivo anual), ex.: 1000000 10000000 50000000.")
+    parser.add_argument('--years', type=int, nargs='+', default=[2023])
+    parser.add_argument('--workdir', default=None, help="Diretório de trabalho (padrão: diretório temporário).")
+    parser.add_argument('--tracemalloc', action='store_true', help="Mede também o pico de memória rastreado pelo tracemalloc.")
+    parser.add_argument('--output', default=None, help="Arquivo JSON-lines onde os resultados são anexados.")
+    args = parser.parse_args()
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+            results = run_scale(workdir, rows, args.years, args.tracemalloc)
+            os.chdir(benchmarks_dir)
+        print_results(rows, results)
+        if args.output:
+            with open(args.output, 'a') as file:
+                record = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'rows': rows, 'years': args.years, 'results': results}
+                file.write(json.dumps(record) + '\n')
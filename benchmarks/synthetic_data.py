@@ -0,0 +1,96 @@
+import argparse
+import csv
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# Gerador de arquivos sintéticos no formato do Comex Stat (EXP_{ano}.csv / IMP_{ano}.csv)
+# e das tabelas auxiliares correspondentes, para os benchmarks da pipeline
+repo_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), os.pardir)
+repo_aux_dir = os.path.join(repo_dir, 'data', 'auxiliar')
+
+EXP_COLUMNS = ['CO_ANO', 'CO_MES', 'CO_NCM', 'CO_UNID', 'CO_PAIS', 'SG_UF_NCM', 'CO_VIA', 'CO_URF', 'QT_ESTAT', 'KG_LIQUIDO', 'VL_FOB']
+IMP_COLUMNS = EXP_COLUMNS + ['VL_FRETE', 'VL_SEGURO']
+UFS = ['AC', 'AL', 'AM', 'AP', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MG', 'MS', 'MT', 'PA', 'PB', 'PE', 'PI', 'PR', 'RJ', 'RN', 'RO', 'RR', 'RS', 'SC', 'SE', 'SP', 'TO', 'ND', 'EX', 'ZN']
+
+def tracked_ncms():
+    with open(os.path.join(repo_aux_dir, 'commodity_catalog.json'), 'r', encoding='utf-8') as file:
+        return [int(ncm) for spec in json.load(file)['commodities'].values() for ncm in spec['ncms']]
+
+def generate_aux_tables(aux_dir, seed=0):
+    # Tabelas auxiliares coerentes com os arquivos do repositório (países, vias e URFs de cod_portos.csv)
+    rng = np.random.default_rng(seed)
+    os.makedirs(aux_dir, exist_ok=True)
+    isos = list(pd.read_csv(os.path.join(repo_aux_dir, 'country_conversion.csv'))['<old>']) + ['ZZZ', 'ZZY']
+    countries = pd.DataFrame({
+        'CO_PAIS': np.arange(len(isos)) * 5 + 13,
+        'CO_PAIS_ISON3': rng.permutation(len(isos)) + 4,
+        'CO_PAIS_ISOA3': isos,
+        'NO_PAIS': [f"PAIS {iso}" for iso in isos],
+        'NO_PAIS_ING': [f"COUNTRY {iso}" for iso in isos],
+        'NO_PAIS_ESP': [f"PAIS {iso}" for iso in isos],
+    })
+    countries.to_csv(os.path.join(aux_dir, 'aux_10.csv'), index=False)
+    pd.DataFrame({'CO_VIA': np.arange(16), 'NO_VIA': [f"VIA {code}" for code in range(16)]}).to_csv(os.path.join(aux_dir, 'aux_14.csv'), index=False)
+    ports = list(pd.read_csv(os.path.join(repo_aux_dir, 'cod_portos.csv'))['NO_URF'])
+    extra = [f"{code:07d} - URF {code}" for code in rng.choice(np.arange(100000, 9999999), 250, replace=False)]
+    names = ports + [name for name in extra if int(name[:7]) not in {int(port[:7]) for port in ports}]
+    pd.DataFrame({'CO_URF': [int(name[:7]) for name in names], 'NO_URF': names}).to_csv(os.path.join(aux_dir, 'aux_15.csv'), index=False)
+    for name in ('commodity_catalog.json', 'cod_portos.csv'):
+        shutil.copy(os.path.join(repo_aux_dir, name), os.path.join(aux_dir, name))
+    return countries['CO_PAIS'].to_numpy(), pd.read_csv(os.path.join(aux_dir, 'aux_15.csv'))['CO_URF'].to_numpy()
+
+def generate_year_file(path, data_type, year, rows, country_codes, urf_codes, ncm_share=0.02, seed=0, chunk_rows=1_000_000):
+    # Escreve o arquivo em blocos (memória limitada), ordenado por mês como os arquivos publicados
+    rng = np.random.default_rng(seed)
+    columns = EXP_COLUMNS if data_type == 'EXP' else IMP_COLUMNS
+    ncms = np.array(tracked_ncms())
+    other_ncms = rng.choice(np.arange(1010000, 97999999), 9000, replace=False)
+    with open(path, 'w', encoding='latin1', newline='') as file:
+        file.write(';'.join(f'"{col}"' for col in columns) + '\r\n')
+        for start in range(0, rows, chunk_rows):
+            size = min(chunk_rows, rows - start)
+            row_index = np.arange(start, start + size)
+            tracked = rng.random(size) < ncm_share
+            chunk = pd.DataFrame({
+                'CO_ANO': np.full(size, year),
+                'CO_MES': pd.Series(1 + row_index * 12 // rows).astype(str).str.zfill(2),
+                'CO_NCM': pd.Series(np.where(tracked, rng.choice(ncms, size), rng.choice(other_ncms, size))).astype(str).str.zfill(8),
+                'CO_UNID': rng.integers(10, 20, size),
+                'CO_PAIS': rng.choice(country_codes, size),
+                'SG_UF_NCM': rng.choice(UFS, size),
+                'CO_VIA': pd.Series(rng.integers(0, 16, size)).astype(str).str.zfill(2),
+                'CO_URF': pd.Series(rng.choice(urf_codes, size)).astype(str).str.zfill(7),
+                'QT_ESTAT': rng.integers(0, 1_000_000, size),
+                'KG_LIQUIDO': rng.integers(0, 10_000_000, size),
+                'VL_FOB': rng.integers(0, 10_000_000, size),
+            })
+            if data_type == 'IMP':
+                chunk['VL_FRETE'] = rng.integers(0, 500_000, size)
+                chunk['VL_SEGURO'] = rng.integers(0, 50_000, size)
+            chunk.to_csv(file, sep=';', header=False, index=False, quoting=csv.QUOTE_ALL, lineterminator='\r\n')
+
+def generate_dataset(output_dir, rows, years=(2023,), ncm_share=0.02, seed=0):
+    # Gera os arquivos anuais de EXP e IMP em output_dir/srv e as tabelas auxiliares em output_dir/auxiliar
+    server_dir = os.path.join(output_dir, 'srv')
+    aux_dir = os.path.join(output_dir, 'auxiliar')
+    os.makedirs(server_dir, exist_ok=True)
+    country_codes, urf_codes = generate_aux_tables(aux_dir, seed)
+    for index, year in enumerate(years):
+        for data_type in ('EXP', 'IMP'):
+            path = os.path.join(server_dir, f"{data_type}_{year}.csv")
+            generate_year_file(path, data_type, year, rows, country_codes, urf_codes, ncm_share, seed + index)
+            print(f"Arquivo sintético gerado: {path} ({rows} linhas)")
+    return server_dir, aux_dir
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Gera arquivos sintéticos no formato do Comex Stat.")
+    parser.add_argument('output_dir')
+    parser.add_argument('--rows', type=int, default=1_000_000, help="Linhas por arquivo anual.")
+    parser.add_argument('--years', type=int, nargs='+', default=[2023])
+    parser.add_argument('--ncm-share', type=float, default=0.02, help="Fração das linhas com NCMs acompanhados.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_dataset(args.output_dir, args.rows, args.years, args.ncm_share, args.seed)
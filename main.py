@@ -1,14 +1,66 @@
+import argparse
 import json
 import requests
-import pandas as pd
 from datetime import datetime, timedelta
-import subprocess
-import io
+import os
+import sys
 import warnings
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+import http_cache
+import fetch_data
+import run_state
+import pipeline
+import metrics
+
 # Suprime apenas o aviso InsecureRequestWarning
 warnings.filterwarnings('ignore', category=requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
+# Tamanho do final do arquivo lido pela sonda de atualização (bastante para várias centenas de linhas)
+PROBE_TAIL_BYTES = 64 * 1024
+BASE_URL = "https://balanca.economia.gov.br/balanca/bd/comexstat-bd/ncm/"
+
+def next_month(year, month):
+    # Mês seguinte ao último atualizado, com a virada de dezembro para janeiro do ano seguinte
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+def parse_period(line):
+    # Extrai (CO_ANO, CO_MES) de uma linha do CSV; devolve None para o cabeçalho e linhas incompletas
+    fields = line.replace('"', '').split(';')
+    if len(fields) < 2 or not fields[0].strip().isdigit() or not fields[1].strip().isdigit():
+        return None
+    return int(fields[0]), int(fields[1])
+
+def probe_tail(response, target):
+    # Resposta parcial (206): a primeira linha pode estar cortada, exceto se o trecho começa no byte 0
+    lines = response.content.decode('latin1').splitlines()
+    if not response.headers.get('Content-Range', '').startswith('bytes 0-'):
+        lines = lines[1:]
+    periods = [period for period in map(parse_period, lines) if period]
+    return bool(periods) and max(periods) >= target
+
+def probe_stream(response, target):
+    # Servidor sem suporte a Range: lê o arquivo em fluxo e para na primeira linha do mês procurado
+    try:
+        for line in response.iter_lines(chunk_size=PROBE_TAIL_BYTES):
+            period = parse_period(line.decode('latin1'))
+            if period and period >= target:
+                return True
+        return False
+    finally:
+        response.close()
+
+def probe_url(year, month):
+    # O mês procurado pode estar no arquivo do ano seguinte (dezembro -> janeiro)
+    return f"{BASE_URL}EXP_{next_month(year, month)[0]}.csv"
+
+def update_target():
+    # Mês procurado pela atualização (o seguinte ao último registrado), no formato AAAA-MM
+    with open('data/logs/update_log.json', 'r') as log_file:
+        update_log = json.load(log_file)
+    year, month = next_month(int(update_log['LAST_UPDATED']['YEAR']), int(update_log['LAST_UPDATED']['MONTH']))
+    return f"{year}-{month:02d}"
+
 def check_data_update():
     with open('data/logs/update_log.json', 'r') as log_file:
         update_log = json.load(log_file)
@@ -16,16 +68,27 @@ def check_data_update():
     last_updated_month = int(update_log['LAST_UPDATED']['MONTH'])
     last_updated_year = int(update_log['LAST_UPDATED']['YEAR'])
 
-    current_year = datetime.now().year
-    url = f"https://balanca.economia.gov.br/balanca/bd/comexstat-bd/ncm/EXP_{current_year}.csv"
-    response = requests.get(url, verify=False)
+    target = next_month(last_updated_year, last_updated_month)
+    url = probe_url(last_updated_year, last_updated_month)
+
+    # Verifica com HEAD se o arquivo existe e se mudou desde a última execução concluída. Os validadores
+    # vêm do log de atualização, e não do cache HTTP: um download de uma execução que falhou (ou de um
+    # backfill) não significa que os dados foram processados
+    head_response = requests.head(url, verify=False, allow_redirects=True, timeout=30)
+    if head_response.status_code == 404:
+        print(f"Arquivo de {target[0]} ainda não publicado.")
+        return False
+    validators = update_log.get('VALIDATORS', {}).get(url)
+    if head_response.status_code == 200 and http_cache.headers_match(validators, head_response.headers):
+        print("Arquivo do ano corrente inalterado desde a última atualização.")
+        return False
 
-    if response.status_code == 200:
-        csv_data = response.text
-        df = pd.read_csv(io.StringIO(csv_data), sep=';')
-        next_month_rows = df[(df['CO_ANO'] == last_updated_year) & (df['CO_MES'] == last_updated_month + 1)]
+    # Os arquivos são ordenados por mês: basta ler o final do arquivo com uma requisição Range
+    response = requests.get(url, headers={'Range': f'bytes=-{PROBE_TAIL_BYTES}'}, verify=False, stream=True, timeout=30)
 
-        if not next_month_rows.empty:
+    if response.status_code in (200, 206):
+        has_update = probe_tail(response, target) if response.status_code == 206 else probe_stream(response, target)
+        if has_update:
             print("Novos dados disponíveis. Procedendo com a atualização.")
             return True
         else:
@@ -35,28 +98,22 @@ def check_data_update():
         print("Falha ao buscar dados da URL.")
         return False
 
-def run_pipeline_scripts():
-    scripts = [
-        'scripts/fetch_data.py',
-        'scripts/join_aux_data.py',
-        'scripts/generate_ipvs.py',
-    ]
-
-    success = True
-    for script in scripts:
-        try:
-            subprocess.run(['python', script], check=True)
-            print(f"Script {script} executado com sucesso.")
-        except subprocess.CalledProcessError as e:
-            print(f"Erro ao executar o script {script}: {e}")
-            success = False
-            break
-
-    return success
+def run_pipeline_stages(incremental=False, backfill=None, checkpoint=False, columnar=None, resume=True, parallel=False, concurrency=None, workers=None, target=None):
+    # Executa as etapas no mesmo processo, passando os DataFrames em memória entre elas.
+    # Uma nova tentativa após falha, para o mesmo mês de atualização, retoma a partir da última etapa concluída
+    try:
+        pipeline.run_pipeline(incremental=incremental, backfill=backfill, checkpoint=checkpoint, concurrency=concurrency, columnar=columnar, resume=resume, parallel=parallel, workers=workers, target=target)
+        print("Pipeline executado com sucesso.")
+        return True
+    except Exception as e:
+        print(f"Erro ao executar o pipeline: {e}")
+        return False
 
 def update_log_file():
-    current_month = datetime.now().month - 1
-    current_year = datetime.now().year
+    # Registra o mês anterior ao atual (em janeiro, dezembro do ano anterior)
+    previous_month = datetime.now().replace(day=1) - timedelta(days=1)
+    current_month = previous_month.month
+    current_year = previous_month.year
 
     with open('data/logs/update_log.json', 'r') as log_file:
         update_log = json.load(log_file)
@@ -64,18 +121,47 @@ def update_log_file():
     update_log['LAST_UPDATED']['MONTH'] = str(current_month)
     update_log['LAST_UPDATED']['YEAR'] = str(current_year)
 
-    with open('data/logs/update_log.json', 'w') as log_file:
-        json.dump(update_log, log_file, indent=2)
+    # Validadores do arquivo que a próxima verificação vai consultar, como baixado por esta execução
+    url = probe_url(current_year, current_month)
+    entry = http_cache.get_entry(url, fetch_data.filtered_suffix(fetch_data.NCM_CODES))
+    update_log['VALIDATORS'] = {url: {'etag': entry.get('etag'), 'last_modified': entry.get('last_modified')}} if entry else {}
+
+    run_state.write_json(update_log, 'data/logs/update_log.json', indent=2)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pipeline de dados do COMEX.")
+    parser.add_argument('--incremental', action='store_true', help="Processa apenas os meses novos ou revisados.")
+    parser.add_argument('--backfill', type=int, nargs=2, metavar=('ANO_INICIAL', 'ANO_FINAL'), help="Reconstrói as séries a partir do intervalo de anos informado.")
+    parser.add_argument('--checkpoint', action='store_true', help="Grava os resultados intermediários em data/raw e data/processed.")
+    parser.add_argument('--columnar', choices=['parquet', 'arrow'], help="Grava também os IPVs consolidados em formato colunar em data/ipvs/columnar.")
+    parser.add_argument('--parallel', action='store_true', help="Gera os IPVs por (tipo de série, fluxo) em paralelo, em um pool de processos.")
+    parser.add_argument('--concurrency', type=int, default=None, help=f"Número máximo de downloads simultâneos (padrão: {fetch_data.DEFAULT_CONCURRENCY}; no backfill, um por processo).")
+    parser.add_argument('--workers', type=int, default=None, help="Processos usados no filtro de NCMs durante o backfill (padrão: todos os núcleos).")
+    parser.add_argument('--no-resume', action='store_true', help="Ignora as etapas já concluídas de uma execução interrompida.")
+    parser.add_argument('--prometheus', action='store_true', help="Exporta as métricas da execução também em data/logs/metrics.prom.")
+    args = parser.parse_args()
     start_time = datetime.now()
-    if check_data_update():
-        if run_pipeline_scripts():
-            update_log_file()
-        else:
+    metrics.start_run()
+    status = 'success'
+    if args.backfill:
+        # O backfill não depende da verificação de novos dados nem atualiza o log de atualização
+        if not run_pipeline_stages(args.incremental, args.backfill, args.checkpoint, args.columnar, not args.no_resume, args.parallel, args.concurrency, args.workers):
             print("Execução do pipeline interrompida.")
+            status = 'failed'
     else:
-        print("Não há novos dados disponíveis.")
+        with metrics.stage('check_update'):
+            has_update = check_data_update()
+        if has_update:
+            if run_pipeline_stages(args.incremental, checkpoint=args.checkpoint, columnar=args.columnar, resume=not args.no_resume, parallel=args.parallel, concurrency=args.concurrency, target=update_target()):
+                update_log_file()
+            else:
+                print("Execução do pipeline interrompida.")
+                status = 'failed'
+        else:
+            print("Não há novos dados disponíveis.")
+            status = 'no_new_data'
+    # Registro estruturado da execução em data/logs/metrics.jsonl
+    metrics.finish_run(status, prometheus=args.prometheus)
     end_time = datetime.now()
     total_time_seconds = (end_time - start_time).total_seconds()
     print(f"Tempo total de execução do COMEX Pipeline: {total_time_seconds:.2f} segundos.")
\ No newline at end of file
@@ -0,0 +1,56 @@
+import pandas as pd
+import os
+import json
+import run_state
+
+# Cache das abas de TABELAS_AUXILIARES.xlsx em formato binário tipado (pickle do pandas),
+# regenerado apenas quando o hash da planilha muda
+script_dir = os.path.abspath(os.path.dirname(__file__))
+aux_dir = os.path.join(script_dir, '..', 'data', 'auxiliar')
+
+def cache_dir(base_path=aux_dir):
+    return os.path.join(base_path, 'cache')
+
+def manifest_path(base_path=aux_dir):
+    return os.path.join(cache_dir(base_path), 'workbook.json')
+
+def cached_table_path(name, base_path=aux_dir):
+    return os.path.join(cache_dir(base_path), f"aux_{name}.pkl")
+
+def table_path(name, base_path=aux_dir):
+    # Usa a tabela binária em cache quando existir; caso contrário, o CSV legado
+    path = cached_table_path(name, base_path)
+    if os.path.exists(path):
+        return path
+    return os.path.join(base_path, f"aux_{name}.csv")
+
+def load_table(name, base_path=aux_dir):
+    path = table_path(name, base_path)
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    return pd.read_csv(path)
+
+def load_manifest(base_path=aux_dir):
+    if not os.path.exists(manifest_path(base_path)):
+        return {}
+    with open(manifest_path(base_path), 'r') as file:
+        return json.load(file)
+
+def workbook_is_current(sha256, base_path=aux_dir):
+    # A planilha está em cache se o hash e a versão do pandas coincidem e todas as abas existem
+    manifest = load_manifest(base_path)
+    if manifest.get('sha256') != sha256 or manifest.get('pandas') != pd.__version__:
+        return False
+    return all(os.path.exists(cached_table_path(name, base_path)) for name in manifest.get('sheets', []))
+
+def save_workbook(sheets, sha256, base_path=aux_dir):
+    os.makedirs(cache_dir(base_path), exist_ok=True)
+    names = []
+    for name, sheet in sheets.items():
+        if name == 'INDEX':
+            continue
+        with run_state.atomic_path(cached_table_path(name, base_path)) as temp_path:
+            sheet.to_pickle(temp_path)
+        names.append(name)
+    run_state.write_json({'sha256': sha256, 'pandas': pd.__version__, 'sheets': names}, manifest_path(base_path), indent=2)
+    return names
@@ -0,0 +1,57 @@
+import functools
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Catálogo único de commodities: grupos (COD_COMM) -> NCMs, e as listas de séries por tipo.
+# É compilado uma vez por processo em um conjunto de NCMs (filtro da coleta), em uma tabela de
+# consulta inteira NCM -> COD_COMM (junção) e nas listas de séries (geração de IPVs)
+script_dir = os.path.abspath(os.path.dirname(__file__))
+aux_dir = os.path.join(script_dir, '..', 'data', 'auxiliar')
+
+def catalog_path(base_path=aux_dir):
+    return os.path.join(base_path, 'commodity_catalog.json')
+
+@functools.lru_cache(maxsize=None)
+def compile_catalog(base_path=aux_dir):
+    with open(catalog_path(base_path), 'r', encoding='utf-8') as file:
+        catalog = json.load(file)
+    ncm_groups = {}
+    for group, spec in catalog['commodities'].items():
+        for ncm in spec['ncms']:
+            if ncm in ncm_groups:
+                raise ValueError(f"NCM {ncm} pertence aos grupos {ncm_groups[ncm]} e {group}.")
+            ncm_groups[ncm] = group
+    # Tabela de consulta no formato de join_aux_data.encode_lookup: chaves inteiras ordenadas,
+    # código do grupo de cada chave e os grupos como categorias
+    groups = pd.Index(list(catalog['commodities']), dtype=object)
+    keys = np.array([int(ncm) for ncm in ncm_groups], dtype='int64')
+    codes = groups.get_indexer(list(ncm_groups.values()))
+    order = np.argsort(keys, kind='stable')
+    return {
+        'ncm_codes': frozenset(ncm_groups),
+        'commodity_lookup': (keys[order], codes[order], groups),
+        'series': catalog['series'],
+    }
+
+def ncm_codes(base_path=aux_dir):
+    return compile_catalog(base_path)['ncm_codes']
+
+def commodity_lookup(base_path=aux_dir):
+    return compile_catalog(base_path)['commodity_lookup']
+
+def series_types(base_path=aux_dir):
+    return list(compile_catalog(base_path)['series'])
+
+def series_column(series_type, base_path=aux_dir):
+    return compile_catalog(base_path)['series'][series_type]['column']
+
+def series_path(series_type, base_path=aux_dir):
+    return os.path.join(base_path, compile_catalog(base_path)['series'][series_type]['file'])
+
+def load_series(series_type, base_path=aux_dir):
+    # Lista de séries (COD_COMM, valor da série) do tipo, restrita aos grupos do catálogo
+    series_df = pd.read_csv(series_path(series_type, base_path))
+    groups = commodity_lookup(base_path)[2]
+    return series_df[series_df['COD_COMM'].isin(groups)].reset_index(drop=True)
@@ -0,0 +1,99 @@
+import pandas as pd
+import os
+import json
+import run_state
+
+# Definição dos caminhos do repositório local de fatos (Parquet particionado por fluxo/ano/mês)
+script_dir = os.path.abspath(os.path.dirname(__file__))
+store_dir = os.path.join(script_dir, '..', 'data', 'store')
+manifest_path = os.path.join(store_dir, 'manifest.json')
+changes_path = os.path.join(store_dir, 'changes.json')
+
+def load_manifest():
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+def save_manifest(manifest):
+    run_state.write_json(manifest, manifest_path, indent=2, sort_keys=True)
+
+def month_key(year, month):
+    return f"{int(year)}-{int(month):02d}"
+
+def partition_path(data_type, year, month):
+    return os.path.join(store_dir, data_type, str(int(year)), f"{int(month):02d}.parquet")
+
+def month_hashes(raw_df):
+    # Calcula um hash por mês dos dados brutos filtrados; a soma dos hashes por linha
+    # independe da ordem das linhas no arquivo de origem
+    hashes = {}
+    for (year, month), group in raw_df.groupby(['CO_ANO', 'CO_MES']):
+        row_hashes = pd.util.hash_pandas_object(group, index=False)
+        hashes[month_key(year, month)] = {'hash': format(int(row_hashes.sum()), '016x'), 'rows': len(group)}
+    return hashes
+
+def changed_months(raw_df, data_type, lookups_digest=None):
+    # Retorna os meses novos ou revisados em relação ao manifesto, com seus hashes. O digest das
+    # tabelas auxiliares faz parte da chave: se elas mudarem, todos os meses são mesclados novamente
+    stored = load_manifest().get(data_type, {})
+    hashes = month_hashes(raw_df)
+    changes = {}
+    for key, value in hashes.items():
+        value['lookups'] = lookups_digest
+        entry = stored.get(key, {})
+        if entry.get('hash') != value['hash'] or entry.get('lookups') != lookups_digest:
+            changes[key] = value
+    return changes
+
+def write_months(processed_df, data_type, changes):
+    # Grava uma partição Parquet por mês alterado e atualiza o manifesto
+    manifest = load_manifest()
+    flow_manifest = manifest.setdefault(data_type, {})
+    for key, info in changes.items():
+        year, month = key.split('-')
+        month_df = processed_df[processed_df['DATA'] == f"{int(year)}-{int(month)}-01"]
+        with run_state.atomic_path(partition_path(data_type, year, month)) as temp_path:
+            month_df.reset_index(drop=True).to_parquet(temp_path, index=False)
+        flow_manifest[key] = info
+    save_manifest(manifest)
+
+def partition_paths(data_type):
+    # Partições do fluxo registradas no manifesto, em ordem cronológica
+    months = sorted(load_manifest().get(data_type, {}), key=lambda key: tuple(int(part) for part in key.split('-')))
+    return [partition_path(data_type, *key.split('-')) for key in months]
+
+def load_facts(data_type):
+    # Carrega todas as partições do fluxo em ordem cronológica
+    frames = [pd.read_parquet(path) for path in partition_paths(data_type)]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+def save_changes(changes):
+    # Registra os meses alterados por fluxo ainda não publicados nos IPVs
+    run_state.write_json({data_type: sorted(months) for data_type, months in changes.items()}, changes_path, indent=2)
+
+def load_changes():
+    if not os.path.exists(changes_path):
+        return {}
+    with open(changes_path, 'r') as file:
+        return json.load(file)
+
+def pending_changes(data_type, months):
+    # Meses alterados agora somados aos pendentes de execuções cuja geração de IPVs não terminou:
+    # o manifesto já registra esses meses, então eles não seriam detectados de novo
+    return sorted(set(months) | set(load_changes().get(data_type, [])))
+
+def clear_changes():
+    # Chamado depois que os IPVs foram publicados
+    if os.path.exists(changes_path):
+        os.remove(changes_path)
+
+def affected_series(series_df, data_df, series_col, months):
+    # Filtra a lista de séries para as que possuem dados em algum dos meses alterados
+    if not months or data_df.empty:
+        return series_df.iloc[0:0]
+    dates = [f"{int(year)}-{int(month)}-01" for year, month in (key.split('-') for key in months)]
+    changed = data_df.loc[data_df['DATA'].isin(dates), ['COD_COMM', series_col]].drop_duplicates()
+    return series_df.merge(changed, on=['COD_COMM', series_col], how='inner')[series_df.columns]
@@ -1,61 +1,196 @@
+import argparse
 import asyncio
 import aiohttp
 import aiofiles
+import backoff
+import collections
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from datetime import datetime
+import io
 import os  # Importa os para verificar existência de arquivo e remoção
 import time  # Importa time para rastrear o tempo de execução
+import hashlib
+import http_cache
+import aux_tables
+import catalog
+import metrics
+import run_state
 
-async def async_retry_request(url, attempts=5, delay=10):
-    # Cria uma sessão HTTP assíncrona para tentar fazer requisições com re-tentativas
-    async with aiohttp.ClientSession() as session:
-        for i in range(2):  # Executa duas tentativas completas
-            for attempt in range(attempts):
-                try:
-                    # Realiza a requisição HTTP GET
-                    async with session.get(url, ssl=False) as response:
-                        response.raise_for_status()
-                        return await response.read()
-                except aiohttp.ClientError as e:
-                    # Gerencia erros e tenta novamente após um delay caso ainda haja tentativas restantes
-                    print(f"Tentativa {attempt+1} de loop {i+1} falhou, erro: {e}")
-                    if attempt < attempts - 1:
-                        await asyncio.sleep(delay)
-            if i == 0:  # Apenas log se não for a última tentativa entre os loops
-                print(f"Reiniciando tentativas após {attempts} falhas.")
-        raise ConnectionError(f"Excedido o número máximo de tentativas após {attempts * 2} tentativas.")
-
-async def download_and_filter_data(years, ncm_codes, data_type, base_url):
-    # Timer inicial para métricas de desempenho
-    start_time = time.time()
-    final_dfs = []
-    for year in years:
+# Limites padrão do agendador de downloads e das re-tentativas
+DEFAULT_CONCURRENCY = int(os.environ.get('COMEX_DOWNLOAD_CONCURRENCY', 4))
+MAX_TRIES = 10
+MAX_BACKOFF = 120
+
+BASE_URL = "https://balanca.economia.gov.br/balanca/bd/comexstat-bd/ncm/"
+AUX_URL = "https://balanca.economia.gov.br/balanca/bd/tabelas/TABELAS_AUXILIARES.xlsx"
+BACKFILL_DIR = "data/raw/backfill"
+# NCMs acompanhados, compilados do catálogo de commodities (data/auxiliar/commodity_catalog.json)
+NCM_CODES = sorted(catalog.ncm_codes())
+
+def create_session(concurrency=DEFAULT_CONCURRENCY):
+    # Sessão HTTP única, com pool de conexões compartilhado por todos os downloads
+    connector = aiohttp.TCPConnector(limit=concurrency, ssl=False)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def is_permanent_error(error):
+    # Erros 4xx (exceto timeout e limite de requisições) não são re-tentados
+    return isinstance(error, aiohttp.ClientResponseError) and 400 <= error.status < 500 and error.status not in (408, 429)
+
+def log_backoff(details):
+    print(f"Tentativa {details['tries']} falhou para {details['args'][1]}, nova tentativa em {details['wait']:.1f} segundos.")
+
+@backoff.on_exception(backoff.expo, (aiohttp.ClientError, asyncio.TimeoutError), max_tries=MAX_TRIES, max_value=MAX_BACKOFF, jitter=backoff.full_jitter, giveup=is_permanent_error, on_backoff=log_backoff)
+async def async_retry_request(session, url, handler=None, headers=None, semaphore=None):
+    # Realiza a requisição HTTP GET na sessão compartilhada, com re-tentativas em backoff exponencial com jitter.
+    # O semáforo limita os downloads simultâneos e é liberado durante a espera entre tentativas.
+    # Se um handler for informado, ele consome a resposta em streaming no lugar de response.read()
+    async with semaphore or contextlib.nullcontext():
+        async with session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            if handler is not None:
+                return await handler(response)
+            return await response.read()
+
+def filtered_suffix(ncm_codes):
+    # Sufixo do artefato filtrado no cache HTTP: um por conjunto de NCMs
+    return f"_{hashlib.sha1(','.join(sorted(ncm_codes)).encode('utf-8')).hexdigest()[:12]}.parquet"
+
+def filter_lines(lines, ncm_codes, ncm_index):
+    # Mantém apenas as linhas cujo campo CO_NCM (sem aspas) pertence ao conjunto de NCMs
+    kept = []
+    for line in lines:
+        fields = line.split(';')
+        if len(fields) > ncm_index and fields[ncm_index].strip('"') in ncm_codes:
+            kept.append(line)
+    return kept
+
+def filter_block(block, ncm_codes, ncm_index):
+    # Decodifica e filtra um bloco de linhas completas; no backfill roda em um processo do pool
+    return filter_lines(block.decode('latin1').split('\n'), ncm_codes, ncm_index)
+
+def make_stream_filter(ncm_codes, chunk_size=1 << 20, executor=None, metric_stage=None, max_pending=2):
+    # Cria um handler que filtra o corpo da resposta à medida que os blocos chegam,
+    # sem manter o arquivo completo em memória nem gravá-lo em disco.
+    # Com um executor, a decodificação e o filtro de cada bloco saem da thread do event loop e o
+    # download continua enquanto até max_pending blocos do arquivo são filtrados no pool
+    ncm_codes = set(ncm_codes)
+    max_pending = max_pending if executor is not None else 0
+
+    async def run_filter(block, ncm_index):
+        if executor is None:
+            kept = filter_block(block, ncm_codes, ncm_index)
+        else:
+            kept = await asyncio.get_running_loop().run_in_executor(executor, filter_block, block, ncm_codes, ncm_index)
+        if metric_stage:
+            # Linhas recebidas e mantidas pelo filtro de NCMs
+            metrics.increment(metric_stage, 'filter_rows_in', block.count(b'\n') + 1)
+            metrics.increment(metric_stage, 'filter_rows_out', len(kept))
+        return kept
+
+    async def handler(response):
+        header = None
+        ncm_index = None
+        kept = []
+        pending = b''
+        # Blocos em filtragem, na ordem do arquivo: só se espera pelo mais antigo quando o limite é atingido
+        in_flight = collections.deque()
+
+        async def submit(block):
+            in_flight.append(asyncio.ensure_future(run_filter(block, ncm_index)))
+            while len(in_flight) > max_pending:
+                kept.extend(await in_flight.popleft())
+
+        try:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                data = pending + chunk
+                # A última linha pode estar incompleta; guarda para o próximo bloco
+                cut = data.rfind(b'\n')
+                if cut < 0:
+                    pending = data
+                    continue
+                block, pending = data[:cut], data[cut + 1:]
+                if header is None:
+                    first_line, _, block = block.partition(b'\n')
+                    header = first_line.decode('latin1').rstrip('\r')
+                    ncm_index = [col.strip('"') for col in header.split(';')].index('CO_NCM')
+                    if not block:
+                        continue
+                await submit(block)
+            if pending:
+                if header is None:
+                    header = pending.decode('latin1').rstrip('\r')
+                else:
+                    await submit(pending)
+            while in_flight:
+                kept.extend(await in_flight.popleft())
+        finally:
+            # Em caso de erro (ex.: conexão interrompida), descarta os blocos ainda em filtragem
+            for future in in_flight:
+                future.cancel()
+        if header is None:
+            raise ValueError("Resposta vazia, cabeçalho CSV não encontrado.")
+        # Apenas as linhas filtradas são convertidas em DataFrame
+        return pd.read_csv(io.StringIO('\n'.join([header] + kept)), delimiter=';')
+
+    return handler
+
+async def fetch_year(session, semaphore, year, ncm_codes, data_type, base_url, streaming=True, executor=None, chunk_size=1 << 20, max_pending=2):
+    # Cada arquivo anual é uma sub-etapa da coleta nas métricas
+    metric_stage = f"fetch.{data_type}_{year}"
+    with metrics.stage(metric_stage):
         file_path = f"data/raw/{data_type}_{year}.csv"
         url = f"{base_url}{data_type}_{year}.csv"
         try:
+            if streaming:
+                # Filtra as linhas durante o download; o arquivo anual nunca é gravado em disco.
+                # O resultado filtrado fica no cache HTTP e é reaproveitado quando o servidor responde 304
+                suffix = filtered_suffix(ncm_codes)
+                handler = http_cache.cached_handler(url, suffix, make_stream_filter(ncm_codes, chunk_size, executor, metric_stage, max_pending), http_cache.save_frame, http_cache.load_frame, metric_stage)
+                df_filtered, changed = await async_retry_request(session, url, handler=handler, headers=http_cache.conditional_headers(url, suffix), semaphore=semaphore)
+                # O artefato do cache é a cópia em disco do resultado, usada para retomar a pipeline
+                df_filtered.attrs['source'] = http_cache.artifact_path(url, suffix)
+                print(f"Arquivo filtrado em streaming: {url} ({len(df_filtered)} linhas mantidas{'' if changed else ', sem alterações'})")
+                return df_filtered
             # Faz download dos dados usando re-tentativas
-            data = await async_retry_request(url)
+            data = await async_retry_request(session, url, semaphore=semaphore)
             # Salva os dados em arquivo CSV
             async with aiofiles.open(file_path, 'wb') as file:
                 await file.write(data)
             print(f"Arquivo baixado salvo em: {file_path}")
             # Carrega o CSV para filtrar dados
             df = pd.read_csv(file_path, delimiter=';', encoding='latin1')
-            df_filtered = df[df['CO_NCM'].astype(str).isin(ncm_codes)]
-            final_dfs.append(df_filtered)
+            return df[df['CO_NCM'].astype(str).isin(ncm_codes)]
         except Exception as e:
             # Gerencia exceções e remove arquivos parciais
             print(f"Falha ao processar {file_path}: {e}")
             if os.path.exists(file_path):
                 os.remove(file_path)
-            continue
+            return None
 
-    if final_dfs:
-        # Concatena todos os dataframes filtrados em um único dataframe
-        final_df = pd.concat(final_dfs, ignore_index=True)
+def save_final_data(final_dfs, data_type, checkpoint=True):
+    if not final_dfs:
+        return None
+    # Concatena todos os dataframes filtrados em um único dataframe, guardando os arquivos de origem
+    # em disco (artefatos do cache HTTP), na mesma ordem, quando todos existem
+    sources = [df.attrs.get('source') for df in final_dfs]
+    final_df = pd.concat(final_dfs, ignore_index=True)
+    final_df.attrs['sources'] = sources if all(sources) else None
+    if checkpoint:
         consolidated_file_path = f"data/raw/{data_type}_final.csv"
-        final_df.to_csv(consolidated_file_path, index=False)
+        with run_state.atomic_path(consolidated_file_path) as temp_path:
+            final_df.to_csv(temp_path, index=False)
         print(f"Dados finais para {data_type} salvos em {consolidated_file_path}")
+    return final_df
+
+async def download_and_filter_data(session, semaphore, years, ncm_codes, data_type, base_url, streaming=True, checkpoint=True):
+    # Timer inicial para métricas de desempenho
+    start_time = time.time()
+    # Baixa todos os anos do fluxo em paralelo, respeitando o limite do semáforo
+    results = await asyncio.gather(*(fetch_year(session, semaphore, year, ncm_codes, data_type, base_url, streaming) for year in years))
+    final_df = save_final_data([df for df in results if df is not None], data_type, checkpoint)
     for year in years:
         file_path = f"data/raw/{data_type}_{year}.csv"
         if os.path.exists(file_path):
@@ -63,54 +198,98 @@ async def download_and_filter_data(years, ncm_codes, data_type, base_url):
     # Timer final para métricas de desempenho
     end_time = time.time()
     print(f"Tempo de execução para download e filtro de dados: {end_time - start_time} segundos")
+    return final_df
 
-async def process_auxiliary_tables(url, output_dir):
+async def process_auxiliary_tables(session, semaphore, url, output_dir):
     # Timer inicial para métricas de desempenho
     start_time = time.time()
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    temp_excel_path = "temp_aux_tables.xlsx"
-    # Faz download dos dados usando re-tentativas
-    data = await async_retry_request(url)
-    async with aiofiles.open(temp_excel_path, 'wb') as file:
-        await file.write(data)
-    # Lê os dados do Excel e grava em CSV segundo diretório de saída e nome do arquivo
-    df = pd.read_excel(temp_excel_path, sheet_name=None)
-    for name, sheet in df.items():
-        if name == 'INDEX':
-            continue
-        output_csv_path = f"{output_dir}/aux_{name}.csv"
-        async with aiofiles.open(output_csv_path, mode='w', encoding='utf-8') as csvfile:
-            await csvfile.write(sheet.to_csv(None, index=False))
-    # print(f"CSV Salvo: {output_csv_path}")
-    os.remove(temp_excel_path)
+    # Faz download dos dados usando re-tentativas, com requisição condicional ao cache HTTP
+    data, changed = await async_retry_request(session, url, handler=http_cache.cached_handler(url, '.xlsx', metric_stage='fetch.auxiliary'), headers=http_cache.conditional_headers(url, '.xlsx'), semaphore=semaphore)
+    # Só analisa a planilha quando o conteúdo muda; as abas ficam em cache como tabelas binárias tipadas
+    digest = hashlib.sha256(data).hexdigest()
+    parsed = not aux_tables.workbook_is_current(digest, output_dir)
+    if not parsed:
+        print("Tabelas auxiliares inalteradas; usando o cache binário.")
+    else:
+        # A leitura do Excel roda em uma thread para não bloquear os demais downloads
+        sheets = await asyncio.to_thread(pd.read_excel, io.BytesIO(data), sheet_name=None)
+        names = aux_tables.save_workbook(sheets, digest, output_dir)
+        print(f"Tabelas auxiliares salvas em cache: {', '.join(names)}")
     # Timer final para métricas de desempenho
     end_time = time.time()
+    metrics.record('fetch.auxiliary', 'duration_seconds', round(end_time - start_time, 6))
+    metrics.record('fetch.auxiliary', 'workbook_parsed', int(parsed))
     print(f"Tempo de execução para processamento de tabelas auxiliares: {end_time - start_time} segundos")
 
-async def main():
+async def main(concurrency=DEFAULT_CONCURRENCY, checkpoint=True):
+    # Devolve os DataFrames filtrados por fluxo; com checkpoint, grava também data/raw/{fluxo}_final.csv
     # Timer geral inicial para o programa
     start_time = time.time()
     years = [str(year) for year in range(datetime.now().year - 1, datetime.now().year+1)]
-    ncm_codes_to_keep = [
-        '10051000', '10059010', '10059090', '12010010', '12010090',
-        '12011000', '12019000', '15071000', '15079011', '15079019',
-        '15079090', '23040010', '23040090', '10011100', '10011090',
-        '10011900', '10019010', '10019090', '10019100', '10019900',
-        '11010010', '11010020'
-    ]
-    base_url = "https://balanca.economia.gov.br/balanca/bd/comexstat-bd/ncm/"
-    aux_url = "https://balanca.economia.gov.br/balanca/bd/tabelas/TABELAS_AUXILIARES.xlsx"
+    ncm_codes_to_keep = NCM_CODES
+    base_url = BASE_URL
+    aux_url = AUX_URL
     output_dir = "data/auxiliar"
-    # Executa tarefas assíncronas em paralelo
-    await asyncio.gather(
-        download_and_filter_data(years, ncm_codes_to_keep, 'EXP', base_url),
-        download_and_filter_data(years, ncm_codes_to_keep, 'IMP', base_url),
-        process_auxiliary_tables(aux_url, output_dir)
-    )
+    # Executa todos os downloads (fluxo, ano) e a planilha auxiliar em paralelo, em uma sessão compartilhada
+    semaphore = asyncio.Semaphore(concurrency)
+    async with create_session(concurrency) as session:
+        exp_df, imp_df, _ = await asyncio.gather(
+            download_and_filter_data(session, semaphore, years, ncm_codes_to_keep, 'EXP', base_url, checkpoint=checkpoint),
+            download_and_filter_data(session, semaphore, years, ncm_codes_to_keep, 'IMP', base_url, checkpoint=checkpoint),
+            process_auxiliary_tables(session, semaphore, aux_url, output_dir)
+        )
     # Timer geral final para o programa
     end_time = time.time()
     print(f"Tempo total de execução do programa: {end_time - start_time} segundos")
+    return {'EXP': exp_df, 'IMP': imp_df}
+
+async def backfill(start_year, end_year, concurrency=None, workers=None, checkpoint=True):
+    # Reconstrói o histórico de um intervalo de anos: os downloads correm em paralelo e o
+    # filtro dos blocos é distribuído em um pool de processos, usando todos os núcleos.
+    # Por padrão há um download simultâneo por processo, e cada arquivo mantém blocos suficientes
+    # em filtragem para ocupar os processos mesmo com menos downloads do que núcleos
+    start_time = time.time()
+    workers = workers or os.cpu_count() or 1
+    concurrency = concurrency or workers
+    max_pending = max(2, -(-workers // concurrency))
+    years = [str(year) for year in range(start_year, end_year + 1)]
+    os.makedirs(BACKFILL_DIR, exist_ok=True)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_partition(session, executor, data_type, year):
+        df = await fetch_year(session, semaphore, year, NCM_CODES, data_type, BASE_URL, executor=executor, chunk_size=8 << 20, max_pending=max_pending)
+        if df is not None:
+            # Grava a partição do ano assim que ela termina
+            partition_path = os.path.join(BACKFILL_DIR, f"{data_type}_{year}.parquet")
+            with run_state.atomic_path(partition_path) as temp_path:
+                df.to_parquet(temp_path, index=False)
+            print(f"Partição salva em: {partition_path}")
+        return df
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        async with create_session(concurrency) as session:
+            results = await asyncio.gather(
+                *(fetch_partition(session, executor, data_type, year) for data_type in ('EXP', 'IMP') for year in years),
+                process_auxiliary_tables(session, semaphore, AUX_URL, "data/auxiliar")
+            )
+    # Consolida as partições de cada fluxo, em ordem de ano, no arquivo usado pelas etapas seguintes
+    final_dfs = {}
+    for index, data_type in enumerate(('EXP', 'IMP')):
+        flow_results = results[index * len(years):(index + 1) * len(years)]
+        final_dfs[data_type] = save_final_data([df for df in flow_results if df is not None], data_type, checkpoint)
+    end_time = time.time()
+    print(f"Tempo total do backfill {start_year}-{end_year}: {end_time - start_time} segundos")
+    return final_dfs
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Coleta e filtra os dados do Comex Stat.")
+    parser.add_argument('--concurrency', type=int, default=None, help=f"Número máximo de downloads simultâneos (padrão: {DEFAULT_CONCURRENCY}; no backfill, um por processo).")
+    parser.add_argument('--backfill', type=int, nargs=2, metavar=('ANO_INICIAL', 'ANO_FINAL'), help="Reconstrói o intervalo de anos informado.")
+    parser.add_argument('--workers', type=int, default=None, help="Processos usados no filtro durante o backfill (padrão: todos os núcleos).")
+    args = parser.parse_args()
+    if args.backfill:
+        asyncio.run(backfill(args.backfill[0], args.backfill[1], args.concurrency, args.workers))
+    else:
+        asyncio.run(main(args.concurrency or DEFAULT_CONCURRENCY))
\ No newline at end of file
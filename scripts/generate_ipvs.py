@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import os
 import glob
 import logging
@@ -7,9 +8,15 @@ import time
 import json
 import datetime
 import re
-
-# Configuração do log detalhado
-logging.basicConfig(filename='data/logs/ipvs_process.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import functools
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import catalog
+import fact_store
+import ipv_store
+import metrics
+import run_state
 
 # Definição dos caminhos
 script_dir = os.path.abspath(os.path.dirname(__file__))
@@ -17,12 +24,41 @@ aux_table_dir = os.path.join(script_dir, '..', 'data', 'auxiliar')
 input_dir = os.path.join(script_dir, '..', 'data', 'processed')
 output_dir = os.path.join(script_dir, '..', 'data', 'ipvs')
 
-# Conversão de códigos de países
-country_conversion = {}
-with open(os.path.join(aux_table_dir, 'country_conversion.csv'), mode='r', encoding='utf-8') as csv_file:
-    csv_reader = csv.DictReader(csv_file)
-    for row in csv_reader:
-        country_conversion[row['<old>']] = row['<new>']
+# Colunas dos arquivos IPV consolidados
+EXPORT_COLUMNS = ['<DATA>', '<KGL>', '<FOB>', '<COD>']
+IMPORT_COLUMNS = ['<DATA>', '<KGL>', '<FOB>', '<VLF>', '<VLS>', '<COD>']
+
+# Colunas de chave das séries consolidadas em memória (commodity, fluxo e código da série no <COD>)
+KEY_COLUMNS = ['COD_COMM', 'FLOW', 'SERIES']
+
+# Níveis de agregação (roll-ups): nome -> (chaves mantidas além de <DATA>, função que monta o <COD>)
+ROLLUP_LEVELS = {
+    'WO': (['COD_COMM', 'FLOW'], lambda keys: 'COMEX:' + keys['COD_COMM'] + '_' + keys['FLOW'] + '_WO_BR'),
+    'TOTAL': (['FLOW', 'SERIES'], lambda keys: 'COMEX:TOTAL_' + keys['FLOW'] + '_' + keys['SERIES'] + '_BR'),
+}
+
+# Roll-ups gerados por tipo de série
+DEFAULT_ROLLUPS = {'country_series': ['WO']}
+
+# Processos do modo paralelo da geração (padrão: um por núcleo)
+DEFAULT_WORKERS = int(os.environ.get('COMEX_GENERATE_WORKERS', os.cpu_count() or 1))
+
+# DataFrames processados por fluxo, compartilhados com os processos do modo paralelo
+SHARED_FRAMES = {}
+
+# Configuração do log detalhado, feita ao iniciar a etapa e não na importação do módulo
+def configure_logging():
+    logging.basicConfig(filename='data/logs/ipvs_process.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Conversão de códigos de países, carregada uma única vez no primeiro uso
+@functools.lru_cache(maxsize=None)
+def load_country_conversion():
+    country_conversion = {}
+    with open(os.path.join(aux_table_dir, 'country_conversion.csv'), mode='r', encoding='utf-8') as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        for row in csv_reader:
+            country_conversion[row['<old>']] = row['<new>']
+    return country_conversion
 
 # Garantir a existência dos diretórios
 def ensure_directories(series_types):
@@ -42,34 +78,152 @@ def load_data(filename):
         logging.error(f"File not found: {path}")
         return pd.DataFrame()
 
-def process_and_save_data(series_df, data_df, output_dir, prefix, series_col, series_type):
-    file_count = 0
-    for index, row in series_df.iterrows():
-        cod_comm = row['COD_COMM']
-        series_value = row[series_col]
-        filtered_data = data_df[(data_df['COD_COMM'] == cod_comm) & (data_df[series_col] == series_value)]
-        if not filtered_data.empty:
-            agg_cols = {'KGL': 'sum', 'FOB': 'sum'}
-            if prefix == 'IMP':
-                agg_cols.update({'VLF': 'sum', 'VLS': 'sum'})
-            aggregated_data = filtered_data.groupby('DATA').agg(agg_cols).reset_index()
+def aggregate_frame(data_df, prefix, series_col):
+    # Agrega todas as séries em uma única passada sobre os dados, indexada por (COD_COMM, série, DATA)
+    agg_cols = ['KGL', 'FOB']
+    if prefix == 'IMP':
+        agg_cols += ['VLF', 'VLS']
+    aggregated = data_df.groupby(['COD_COMM', series_col, 'DATA'], observed=True)[agg_cols].sum().reset_index()
+    # Chaves categóricas viram texto e a ordenação é lexicográfica, como nos dados lidos de CSV
+    for col in ('COD_COMM', series_col, 'DATA'):
+        aggregated[col] = aggregated[col].astype(object)
+    return aggregated.sort_values(['COD_COMM', series_col, 'DATA'], kind='stable')
+
+def aggregate_series(data_df, prefix, series_col):
+    aggregated = aggregate_frame(data_df, prefix, series_col)
+    # Divide o resultado em um DataFrame por série (DATA + colunas agregadas)
+    return {key: group.drop(columns=['COD_COMM', series_col]).reset_index(drop=True) for key, group in aggregated.groupby(['COD_COMM', series_col], sort=False)}
+
+def iter_series(series_df, data_df, prefix, series_col, series_type):
+    # Gera (nome da série, DataFrame agregado) para cada série com dados, na ordem da lista de séries
+    series_groups = aggregate_series(data_df, prefix, series_col)
+    country_conversion = load_country_conversion()
+    for cod_comm, series_value in series_df[['COD_COMM', series_col]].itertuples(index=False):
+        if (cod_comm, series_value) in series_groups:
+            aggregated_data = series_groups[(cod_comm, series_value)].copy()
             if series_type == 'country_series':
                 country_code = country_conversion.get(series_value, 'XX')
             else:
                 country_code = series_value
             suffix = '_BR'
             aggregated_data['COD'] = f"COMEX:{cod_comm}_{prefix[:2]}_{country_code}{suffix}"
-            output_file = os.path.join(output_dir, f"{cod_comm}_{prefix[:2]}_{country_code}{suffix}.ipv")
             aggregated_data.columns = ['<' + col + '>' for col in aggregated_data.columns]
-            aggregated_data.to_csv(output_file, index=False)
-            logging.info(f"Data processed and saved for {cod_comm} at {output_file}")
-            file_count += 1
+            yield f"{cod_comm}_{prefix[:2]}_{country_code}{suffix}", aggregated_data
         else:
             logging.warning(f"No data found for {cod_comm} - {series_value}. Skipping.")
+
+def process_and_save_data(series_df, data_df, output_dir, prefix, series_col, series_type):
+    file_count = 0
+    for series_name, aggregated_data in iter_series(series_df, data_df, prefix, series_col, series_type):
+        output_file = os.path.join(output_dir, f"{series_name}.ipv")
+        with run_state.atomic_path(output_file) as temp_path:
+            aggregated_data.to_csv(temp_path, index=False)
+        logging.info(f"Data processed and saved for {series_name[:3]} at {output_file}")
+        metrics.increment(f'generate.{series_type}', 'files_written')
+        file_count += 1
     return file_count
 
+def build_consolidated(series_df, data_df, prefix, series_col, series_type):
+    # Monta em memória o equivalente à concatenação dos arquivos por série, com junções vetorizadas
+    # entre a lista de séries e os dados agregados (sem laço por série). Séries com o mesmo nome
+    # substituem as anteriores na posição da primeira, como ao sobrescrever o arquivo .ipv.
+    # As chaves de cada série acompanham as linhas, para os roll-ups não dependerem do <COD>
+    names = EXPORT_COLUMNS if prefix == 'EXP' else IMPORT_COLUMNS
+    aggregated = aggregate_frame(data_df, prefix, series_col)
+    series = series_df[['COD_COMM', series_col]].reset_index(drop=True)
+    if series_type == 'country_series':
+        series['SERIES'] = series[series_col].map(load_country_conversion()).fillna('XX')
+    else:
+        series['SERIES'] = series[series_col].astype(str)
+    series['NAME'] = series['COD_COMM'].astype(str) + f"_{prefix[:2]}_" + series['SERIES'] + '_BR'
+
+    # Séries sem dados são registradas no log e ignoradas
+    available = pd.MultiIndex.from_frame(series[['COD_COMM', series_col]]).isin(pd.MultiIndex.from_frame(aggregated[['COD_COMM', series_col]]))
+    for cod_comm, series_value in series.loc[~available, ['COD_COMM', series_col]].itertuples(index=False):
+        logging.warning(f"No data found for {cod_comm} - {series_value}. Skipping.")
+    series = series[available]
+    file_count = len(series)
+    if series.empty:
+        return pd.DataFrame(columns=names + KEY_COLUMNS), file_count
 
-def consolidate_ipvs(series_type_dir, series_type):
+    series = series.assign(ORDER=series.groupby('NAME', sort=False).ngroup()).drop_duplicates('NAME', keep='last')
+    merged = series.merge(aggregated, on=['COD_COMM', series_col], how='inner').sort_values('ORDER', kind='stable')
+    consolidated = pd.DataFrame({'<' + col + '>': merged[col].to_numpy() for col in aggregated.columns if col not in ('COD_COMM', series_col)})
+    consolidated['<COD>'] = ('COMEX:' + merged['NAME']).to_numpy()
+    consolidated['COD_COMM'] = merged['COD_COMM'].to_numpy()
+    consolidated['FLOW'] = prefix[:2]
+    consolidated['SERIES'] = merged['SERIES'].to_numpy()
+    return consolidated, file_count
+
+def consolidated_filenames(series_type_dir, series_type):
+    formatted_date = datetime.datetime.now().strftime('%Y_%m')
+    export_filename = os.path.join(series_type_dir, f"{series_type}_exports_{formatted_date}.ipv")
+    import_filename = os.path.join(series_type_dir, f"{series_type}_imports_{formatted_date}.ipv")
+    return export_filename, import_filename
+
+def publish_flow(series_type_dir, series_type, flow, df, incremental=False, rollups=()):
+    # Publica o arquivo consolidado de um fluxo; devolve o DataFrame final e o caminho do arquivo
+    export_filename, import_filename = consolidated_filenames(series_type_dir, series_type)
+    filename, kind, names = (export_filename, 'exports', EXPORT_COLUMNS) if flow == 'EXP' else (import_filename, 'imports', IMPORT_COLUMNS)
+    if incremental:
+        df = merge_previous_consolidated(series_type_dir, f"{series_type}_{kind}_*.ipv", df, names)
+    df = add_rollup_rows(df, rollups)
+    df = format_dates(df)
+    # O arquivo é publicado de forma atômica (arquivo temporário + rename)
+    with run_state.atomic_path(filename) as temp_path:
+        df.to_csv(temp_path, index=False)
+    metrics.increment(f'generate.{series_type}', 'files_written')
+    metrics.increment(f'generate.{series_type}', 'rows_written', len(df))
+    print(f"{'Exportação' if flow == 'EXP' else 'Importação'} de dados consolidada e salva em: {filename}")
+    return df, filename
+
+def write_columnar(series_type, df_exports, df_imports, columnar):
+    # Grava os mesmos DataFrames dos arquivos .ipv consolidados no formato colunar (parquet ou arrow)
+    return [write_columnar_flow(series_type, flow, df, columnar) for flow, df in (('EXP', df_exports), ('IMP', df_imports))]
+
+def write_columnar_flow(series_type, flow, df, columnar):
+    path = ipv_store.write_frame(df, series_type, flow, columnar)
+    metrics.increment(f'generate.{series_type}', 'columnar_files_written')
+    print(f"Saída colunar ({columnar}) salva em: {path}")
+    return path
+
+def generate_flow(series_type, flow, incremental=False, changes=None, columnar=None, rollups=()):
+    # Unidade de trabalho independente: um tipo de série e um fluxo, dos dados processados em
+    # SHARED_FRAMES até o arquivo consolidado publicado. Devolve (séries geradas, arquivos publicados)
+    data_df = SHARED_FRAMES[flow]
+    series_df = catalog.load_series(series_type)
+    series_col = catalog.series_column(series_type)
+    if incremental:
+        series_df = fact_store.affected_series(series_df, data_df, series_col, (changes or {}).get(flow))
+    df, series_count = build_consolidated(series_df, data_df, flow, series_col, series_type)
+    df, filename = publish_flow(os.path.join('data', 'ipvs', series_type), series_type, flow, df, incremental, rollups)
+    published = [filename]
+    if columnar:
+        published.append(write_columnar_flow(series_type, flow, df, columnar))
+    return series_count, published
+
+def generate_task(task):
+    with metrics.stage(f'generate.{task[0]}'):
+        return generate_flow(*task)
+
+def run_worker(task):
+    # Executado em um processo do pool: as métricas do filho voltam ao processo principal
+    metrics.current_run['stages'] = {}
+    series_count, published = generate_task(task)
+    return series_count, published, metrics.current_run['stages']
+
+def generate_parallel(tasks, workers=None):
+    # Os processos são criados por fork depois de SHARED_FRAMES ser preenchido: os DataFrames
+    # processados são herdados sem cópia (copy-on-write) e apenas as tarefas trafegam entre processos
+    context = multiprocessing.get_context('fork')
+    results = []
+    with ProcessPoolExecutor(max_workers=min(workers or DEFAULT_WORKERS, len(tasks)), mp_context=context) as executor:
+        for series_count, published, stages in executor.map(run_worker, tasks):
+            metrics.merge_stages(stages)
+            results.append((series_count, published))
+    return results
+
+def consolidate_ipvs(series_type_dir, series_type, incremental=False):
     # Define paths and patterns for file types
     export_pattern = os.path.join(series_type_dir, f"???_EX_*.ipv")
     import_pattern = os.path.join(series_type_dir, f"???_IM_*.ipv")
@@ -79,20 +233,25 @@ def consolidate_ipvs(series_type_dir, series_type):
     import_files = glob.glob(import_pattern)
 
     # Read and concatenate export files with ignoring headers
-    df_exports = pd.concat([pd.read_csv(file, skiprows=1, names=['<DATA>', '<KGL>', '<FOB>', '<COD>']) for file in export_files])
+    df_exports = pd.concat([pd.read_csv(file, skiprows=1, names=EXPORT_COLUMNS) for file in export_files] or [pd.DataFrame(columns=EXPORT_COLUMNS)])
 
     # Read and concatenate import files with ignoring headers
-    df_imports = pd.concat([pd.read_csv(file, skiprows=1, names=['<DATA>', '<KGL>', '<FOB>', '<VLF>', '<VLS>', '<COD>']) for file in import_files])
+    df_imports = pd.concat([pd.read_csv(file, skiprows=1, names=IMPORT_COLUMNS) for file in import_files] or [pd.DataFrame(columns=IMPORT_COLUMNS)])
 
     # Define output file names
-    current_date = datetime.datetime.now()
-    formatted_date = current_date.strftime('%Y_%m')
-    export_filename = os.path.join(series_type_dir, f"{series_type}_exports_{formatted_date}.ipv")
-    import_filename = os.path.join(series_type_dir, f"{series_type}_imports_{formatted_date}.ipv")
+    formatted_date = datetime.datetime.now().strftime('%Y_%m')
+    export_filename, import_filename = consolidated_filenames(series_type_dir, series_type)
 
-    # Save to new files
-    df_exports.to_csv(export_filename, index=False)
-    df_imports.to_csv(import_filename, index=False)
+    # In incremental mode, keep the unaffected series from the latest consolidated files
+    if incremental:
+        df_exports = merge_previous_consolidated(series_type_dir, f"{series_type}_exports_*.ipv", df_exports, EXPORT_COLUMNS)
+        df_imports = merge_previous_consolidated(series_type_dir, f"{series_type}_imports_*.ipv", df_imports, IMPORT_COLUMNS)
+
+    # Save to new files (atomically, before the per-series files are removed)
+    with run_state.atomic_path(export_filename) as temp_path:
+        df_exports.to_csv(temp_path, index=False)
+    with run_state.atomic_path(import_filename) as temp_path:
+        df_imports.to_csv(temp_path, index=False)
 
     # Remove older files
     for file in export_files + import_files:
@@ -105,44 +264,86 @@ def consolidate_ipvs(series_type_dir, series_type):
     print(f"Exportação de dados consolidada e salva em: {export_filename}")
     print(f"Importação de dados consolidada e salva em: {import_filename}")
 
-def generate_wo_rows(file_path):
+def merge_previous_consolidated(series_type_dir, pattern, df_new, names):
+    previous_files = sorted(glob.glob(os.path.join(series_type_dir, pattern)))
+    # Pad the dates of the regenerated rows so they match the already formatted previous rows
+    df_new = format_dates(df_new)
+    if not previous_files:
+        return df_new
+    df_previous = pd.read_csv(previous_files[-1])
+    # Drop regenerated series and the roll-up rows, which are rebuilt by add_rollup_rows
+    keep = ~df_previous['<COD>'].isin(df_new['<COD>']) & ~is_rollup_code(df_previous['<COD>'])
+    logging.info(f"Merging {keep.sum()} unchanged rows from {previous_files[-1]}")
+    return pd.concat([df_previous.loc[keep, names], df_new], ignore_index=True)
+
+def generate_wo_rows(file_path, levels=('WO',)):
     # Load the data
     df = pd.read_csv(file_path)
 
-    # Function to extract commodity code and series type
-    def extract_details(cod):
-        commodity_code = cod[6:9]
-        series_type = cod[10:12]
-        return commodity_code, series_type
+    df = add_rollup_rows(df, levels)
 
-    # Apply the function to extract data
-    df['Commodity_Code'], df['Series_Type'] = zip(*df['<COD>'].apply(extract_details))
+    # Save to the same file
+    with run_state.atomic_path(file_path) as temp_path:
+        df.to_csv(temp_path, index=False)
+    print(f"Arquivo atualizado com linhas de visão global: {file_path}")
 
-    # Define aggregation dictionary
-    aggregation_dict = {'<KGL>': 'sum', '<FOB>': 'sum'}
+def is_rollup_code(cods):
+    return cods.str.endswith('_WO_BR') | cods.str.startswith('COMEX:TOTAL_')
 
-    # Include VLF and VLS in aggregation if available
-    if '<VLF>' in df.columns and '<VLS>' in df.columns:
-        aggregation_dict.update({'<VLF>': 'sum', '<VLS>': 'sum'})
+def series_keys(df):
+    # Chaves estruturadas das séries. Linhas sem chave (lidas de arquivos .ipv) têm as chaves
+    # extraídas do <COD> com uma única expressão regular vetorizada
+    if set(KEY_COLUMNS).issubset(df.columns):
+        keys = df[KEY_COLUMNS].astype(object)
+    else:
+        keys = pd.DataFrame(index=df.index, columns=KEY_COLUMNS, dtype=object)
+    missing = keys.isna().any(axis=1)
+    if missing.any():
+        keys.loc[missing, KEY_COLUMNS] = df.loc[missing, '<COD>'].str.extract(r'^COMEX:([^_]+)_([^_]+)_(.+)_BR$').to_numpy()
+    return keys
 
-    # Aggregate data
-    agg_df = df.groupby(['<DATA>', 'Commodity_Code', 'Series_Type']).agg(aggregation_dict).reset_index()
+def add_rollup_rows(df, levels=('WO',)):
+    # Acrescenta as linhas agregadas de cada nível em ROLLUP_LEVELS. Todos os níveis saem de um único
+    # groupby: as chaves de cada nível são empilhadas, com -1 nas dimensões agregadas
+    if not levels:
+        return df[[col for col in df.columns if col not in KEY_COLUMNS]]
+    agg_cols = [col for col in ['<KGL>', '<FOB>', '<VLF>', '<VLS>'] if col in df.columns]
+    keys = series_keys(df)
+    codes = {}
+    uniques = {}
+    for col in ['<DATA>'] + KEY_COLUMNS:
+        values = df['<DATA>'] if col == '<DATA>' else keys[col]
+        codes[col], uniques[col] = pd.factorize(values.astype(object), sort=True)
+    rows = len(df)
+    stacked = {'LEVEL': np.repeat(np.arange(len(levels)), rows), '<DATA>': np.tile(codes['<DATA>'], len(levels))}
+    for col in KEY_COLUMNS:
+        stacked[col] = np.concatenate([codes[col] if col in ROLLUP_LEVELS[level][0] else np.full(rows, -1) for level in levels])
+    for col in agg_cols:
+        stacked[col] = np.tile(df[col].to_numpy(), len(levels))
+    grouped = pd.DataFrame(stacked).groupby(['LEVEL', '<DATA>'] + KEY_COLUMNS, sort=True)[agg_cols].sum().reset_index()
 
-    # Create new <COD> format and append rows
-    agg_df['<COD>'] = 'COMEX:' + agg_df['Commodity_Code'] + '_' + agg_df['Series_Type'] + '_WO_BR'
-    agg_df.drop(['Commodity_Code', 'Series_Type'], axis=1, inplace=True)
+    # Monta o <COD> de cada nível a partir das chaves decodificadas
+    rollup_frames = []
+    for index, level in enumerate(levels):
+        level_rows = grouped[grouped['LEVEL'] == index]
+        level_keys = pd.DataFrame({col: pd.Series(uniques[col]).take(level_rows[col]).to_numpy() for col in ROLLUP_LEVELS[level][0]})
+        rollup = level_rows[agg_cols].reset_index(drop=True)
+        rollup.insert(0, '<DATA>', pd.Series(uniques['<DATA>']).take(level_rows['<DATA>']).to_numpy())
+        rollup['<COD>'] = ROLLUP_LEVELS[level][1](level_keys).to_numpy()
+        rollup_frames.append(rollup)
 
     # Append and merge the original DataFrame with new aggregated rows
-    df = pd.concat([df, agg_df], ignore_index=True)
+    df = pd.concat([df.drop(columns=KEY_COLUMNS, errors='ignore')] + rollup_frames, ignore_index=True)
 
     # Remove unnecessary columns for export and import
-    df = df[['<DATA>', '<KGL>', '<FOB>', '<COD>'] + (['<VLF>', '<VLS>'] if '<VLF>' in df.columns else [])]
+    return df[['<DATA>', '<KGL>', '<FOB>', '<COD>'] + (['<VLF>', '<VLS>'] if '<VLF>' in df.columns else [])]
 
-    # Save to the same file
-    df.to_csv(file_path, index=False)
-    print(f"Arquivo atualizado com linhas de visão global: {file_path}")
+def format_dates(df):
+    # Same zero-padding of the month as format_dates_in_files, applied to the <DATA> column in memory
+    df = df.copy()
+    df['<DATA>'] = df['<DATA>'].astype(str).str.replace(r'(\d{4})-(\d{1})-', r'\1-0\2-', regex=True)
+    return df
 
-directory = "data\\ipvs"
 def format_dates_in_files(directory):
     # Iterate through subfolders and files in the directory
     for subdir, dirs, files in os.walk(directory):
@@ -151,45 +352,78 @@ def format_dates_in_files(directory):
 
             # Check if the file extension is .ipv
             if filepath.endswith(".ipv"):
-                with open(filepath, 'r+') as f:
+                with open(filepath, 'r') as f:
                     content = f.readlines()
-                    f.seek(0)
-                    for line in content:
-                        # Match and format date in the <DATA> column
-                        line = re.sub(r'(\d{4})-(\d{1})-', r'\1-0\2-', line)
-                        f.write(line)
-                    f.truncate()
+                with run_state.atomic_path(filepath) as temp_path:
+                    with open(temp_path, 'w') as f:
+                        for line in content:
+                            # Match and format date in the <DATA> column
+                            line = re.sub(r'(\d{4})-(\d{1})-', r'\1-0\2-', line)
+                            f.write(line)
 
 # Função principal para orquestrar o processamento
-def main():
+def main(incremental=False, per_series_files=False, exp_data=None, imp_data=None, changes=None, columnar=None, rollups=None, parallel=False, workers=None):
+    # Os dados processados podem vir em memória da etapa de junção; caso contrário são lidos de data/processed.
+    # Devolve os caminhos dos arquivos consolidados publicados
+    configure_logging()
     start_time = time.time()
-    series_types = ['country_series', 'harbor_series', 'state_series']
+    series_types = catalog.series_types()
     ensure_directories(series_types)
-    exp_data = load_data('EXP_final_processed.csv')
-    imp_data = load_data('IMP_final_processed.csv')
-    series_files = {
-        'country_series': 'country_series.csv',
-        'harbor_series': 'harbor_series.csv',
-        'state_series': 'state_series.csv'
-    }
+    if exp_data is None:
+        exp_data = load_data('EXP_final_processed.csv')
+    if imp_data is None:
+        imp_data = load_data('IMP_final_processed.csv')
+    # No modo incremental, apenas as séries com dados nos meses alterados são regeneradas
+    if changes is None:
+        changes = fact_store.load_changes() if incremental else {}
+    rollups = DEFAULT_ROLLUPS if rollups is None else rollups
     file_count_total = 0
-    for series_type, file_name in series_files.items():
-        series_df = load_data(os.path.join(aux_table_dir, file_name))
-        file_count_total += process_and_save_data(series_df, exp_data, os.path.join(output_dir, series_type), 'EXP', 'CO_PAIS_ISOA3' if series_type == 'country_series' else 'COD_URF' if series_type == 'harbor_series' else 'SG_UF_NCM', series_type)
-        file_count_total += process_and_save_data(series_df, imp_data, os.path.join(output_dir, series_type), 'IMP', 'CO_PAIS_ISOA3' if series_type == 'country_series' else 'COD_URF' if series_type == 'harbor_series' else 'SG_UF_NCM', series_type)
-    consolidate_ipvs('data/ipvs/country_series', 'country_series')
-    current_date = datetime.datetime.now()
-    formatted_date = current_date.strftime('%Y_%m')
-    generate_wo_rows(f'data/ipvs/country_series/country_series_exports_{formatted_date}.ipv')
-    generate_wo_rows(f'data/ipvs/country_series/country_series_imports_{formatted_date}.ipv')
-    consolidate_ipvs('data/ipvs/harbor_series', 'harbor_series')
-    consolidate_ipvs('data/ipvs/state_series', 'state_series')
-    format_dates_in_files(output_dir)
+    published = []
+    if per_series_files:
+        for series_type in series_types:
+            # Lista de séries e coluna da série vêm do catálogo de commodities
+            series_df = catalog.load_series(series_type)
+            series_col = catalog.series_column(series_type)
+            exp_series_df = fact_store.affected_series(series_df, exp_data, series_col, changes.get('EXP')) if incremental else series_df
+            imp_series_df = fact_store.affected_series(series_df, imp_data, series_col, changes.get('IMP')) if incremental else series_df
+            with metrics.stage(f'generate.{series_type}'):
+                series_count = file_count_total
+                series_type_dir = os.path.join('data', 'ipvs', series_type)
+                # Modo legado: um arquivo por série, consolidado depois via glob
+                file_count_total += process_and_save_data(exp_series_df, exp_data, os.path.join(output_dir, series_type), 'EXP', series_col, series_type)
+                file_count_total += process_and_save_data(imp_series_df, imp_data, os.path.join(output_dir, series_type), 'IMP', series_col, series_type)
+                consolidate_ipvs(series_type_dir, series_type, incremental)
+                export_filename, import_filename = consolidated_filenames(series_type_dir, series_type)
+                published += [export_filename, import_filename]
+                if rollups.get(series_type):
+                    generate_wo_rows(export_filename, rollups[series_type])
+                    generate_wo_rows(import_filename, rollups[series_type])
+                if columnar:
+                    published += write_columnar(series_type, format_dates(pd.read_csv(export_filename)), format_dates(pd.read_csv(import_filename)), columnar)
+                metrics.record(f'generate.{series_type}', 'series_generated', file_count_total - series_count)
+        format_dates_in_files(output_dir)
+    else:
+        # Consolida em memória e grava cada arquivo final uma única vez. Cada par (tipo de série, fluxo)
+        # é uma unidade independente, executada em sequência ou, com parallel=True, em um pool de processos
+        SHARED_FRAMES.update({'EXP': exp_data, 'IMP': imp_data})
+        tasks = [(series_type, flow, incremental, changes, columnar, rollups.get(series_type, [])) for series_type in series_types for flow in ('EXP', 'IMP')]
+        results = generate_parallel(tasks, workers) if parallel else [generate_task(task) for task in tasks]
+        for task, (series_count, paths) in zip(tasks, results):
+            metrics.increment(f'generate.{task[0]}', 'series_generated', series_count)
+            file_count_total += series_count
+            published += paths
+        SHARED_FRAMES.clear()
+    # Os meses alterados só deixam de ser pendentes depois que os IPVs foram publicados
+    fact_store.clear_changes()
     end_time = time.time()
     logging.info(f"Total files created: {file_count_total}")
     print(f"Total de códigos atualizados: {file_count_total}")
     logging.info(f"Tempo total de execução: {end_time - start_time:.2f} segundos")
     print(f"Tempo total de execução: {end_time - start_time:.2f} segundos")
+    return published
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    # --parquet ou --arrow gravam também a saída colunar em data/ipvs/columnar
+    columnar = 'arrow' if '--arrow' in sys.argv else 'parquet' if '--parquet' in sys.argv else None
+    # --parallel distribui a geração por (tipo de série, fluxo) em processos (COMEX_GENERATE_WORKERS)
+    main(incremental='--incremental' in sys.argv, per_series_files='--per-series-files' in sys.argv, columnar=columnar, parallel='--parallel' in sys.argv)
\ No newline at end of file
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import time
+import pandas as pd
+import metrics
+import run_state
+
+# Cache local de downloads, indexado por artefato (URL + sufixo do resultado derivado), com os validadores
+# HTTP (ETag/Last-Modified) e o hash do conteúdo da resposta que produziu cada artefato
+script_dir = os.path.abspath(os.path.dirname(__file__))
+cache_dir = os.path.join(script_dir, '..', 'data', 'cache', 'http')
+index_path = os.path.join(cache_dir, 'index.json')
+
+def url_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+def load_index():
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path, 'r') as file:
+        return json.load(file)
+
+def save_index(index):
+    run_state.write_json(index, index_path, indent=2, sort_keys=True)
+
+def artifact_name(url, suffix):
+    return f"{url_key(url)}{suffix}"
+
+def artifact_path(url, suffix):
+    # Caminho do artefato derivado da resposta (corpo bruto ou resultado já filtrado)
+    return os.path.join(cache_dir, artifact_name(url, suffix))
+
+def get_entry(url, suffix):
+    # Os validadores valem apenas para o artefato gerado a partir da resposta que os trouxe: uma URL
+    # com vários artefatos (ex.: filtros com conjuntos de NCMs diferentes) tem uma entrada para cada
+    return load_index().get(artifact_name(url, suffix))
+
+def record(url, suffix, response_headers, sha256, size):
+    index = load_index()
+    index[artifact_name(url, suffix)] = {
+        'url': url,
+        'suffix': suffix,
+        'etag': response_headers.get('ETag'),
+        'last_modified': response_headers.get('Last-Modified'),
+        'sha256': sha256,
+        'size': size,
+    }
+    save_index(index)
+
+def conditional_headers(url, suffix):
+    # Só envia validadores se o artefato correspondente ainda existir no cache
+    entry = get_entry(url, suffix)
+    if not entry or not os.path.exists(artifact_path(url, suffix)):
+        return {}
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def headers_match(entry, response_headers):
+    # Compara os validadores de uma resposta (ex.: HEAD) com uma entrada {'etag', 'last_modified'}
+    if not entry:
+        return False
+    etag = response_headers.get('ETag')
+    if etag and entry.get('etag'):
+        return etag == entry['etag']
+    last_modified = response_headers.get('Last-Modified')
+    if last_modified and entry.get('last_modified'):
+        return last_modified == entry['last_modified']
+    return False
+
+class HashingContent:
+    # Repassa os blocos do corpo da resposta calculando o SHA-256 e o tamanho em paralelo
+    def __init__(self, content):
+        self._content = content
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    async def iter_chunked(self, chunk_size):
+        async for chunk in self._content.iter_chunked(chunk_size):
+            self.sha256.update(chunk)
+            self.size += len(chunk)
+            yield chunk
+
+class HashingResponse:
+    def __init__(self, response):
+        self.status = response.status
+        self.headers = response.headers
+        self.url = response.url
+        self.content = HashingContent(response.content)
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.content.iter_chunked(1 << 20)])
+
+def save_frame(df, path):
+    with run_state.atomic_path(path) as temp_path:
+        df.to_parquet(temp_path, index=False)
+
+def load_frame(path):
+    return pd.read_parquet(path)
+
+def save_bytes(data, path):
+    with run_state.atomic_path(path) as temp_path:
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+
+def load_bytes(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+def cached_handler(url, suffix, handler=None, save=save_bytes, load=load_bytes, metric_stage=None):
+    # Cria um handler para async_retry_request que devolve (resultado, alterado):
+    # em 304 carrega o artefato do cache; em 200 processa a resposta, grava o artefato e os validadores
+    async def wrapped(response):
+        path = artifact_path(url, suffix)
+        if response.status == 304:
+            print(f"Sem alterações desde o último download: {url}")
+            if metric_stage:
+                metrics.increment(metric_stage, 'not_modified')
+            return load(path), False
+        hashing = HashingResponse(response)
+        # Tempo de transferência do corpo (com o filtro em streaming), base do throughput nas métricas
+        start_time = time.perf_counter()
+        result = await (handler(hashing) if handler is not None else hashing.read())
+        transfer_seconds = time.perf_counter() - start_time
+        digest = hashing.content.sha256.hexdigest()
+        entry = get_entry(url, suffix)
+        changed = entry is None or entry.get('sha256') != digest
+        os.makedirs(cache_dir, exist_ok=True)
+        save(result, path)
+        record(url, suffix, response.headers, digest, hashing.content.size)
+        if metric_stage:
+            metrics.increment(metric_stage, 'download_bytes', hashing.content.size)
+            metrics.increment(metric_stage, 'transfer_seconds', round(transfer_seconds, 6))
+        return result, changed
+
+    return wrapped
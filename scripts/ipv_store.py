@@ -0,0 +1,49 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import run_state
+
+# Saída colunar dos IPVs consolidados (Parquet ou Arrow IPC), com um diretório por formato particionado
+# por tipo de série e fluxo no layout Hive (<formato>/series_type=.../flow=...), com DATA como data e
+# não texto. Todos os arquivos têm o mesmo esquema: na exportação, VLF e VLS são gravados como nulos
+script_dir = os.path.abspath(os.path.dirname(__file__))
+columnar_dir = os.path.join(script_dir, '..', 'data', 'ipvs', 'columnar')
+
+FORMATS = {'parquet': 'part.parquet', 'arrow': 'part.arrow'}
+SCHEMA = pa.schema([
+    ('DATA', pa.date32()),
+    ('KGL', pa.int64()),
+    ('FOB', pa.int64()),
+    ('VLF', pa.int64()),
+    ('VLS', pa.int64()),
+    ('COD', pa.string()),
+])
+
+def partition_path(series_type, flow, output_format='parquet', base_path=columnar_dir):
+    return os.path.join(base_path, output_format, f"series_type={series_type}", f"flow={flow}", FORMATS[output_format])
+
+def to_table(df):
+    # Colunas sem os delimitadores <...>, na ordem do esquema (as ausentes ficam nulas), e DATA como date32
+    frame = df.rename(columns=lambda column: column.strip('<>')).reset_index(drop=True).reindex(columns=SCHEMA.names)
+    frame['DATA'] = pd.to_datetime(frame['DATA'], format='%Y-%m-%d')
+    frame['COD'] = frame['COD'].astype(str)
+    return pa.Table.from_pandas(frame, schema=SCHEMA, preserve_index=False)
+
+def write_frame(df, series_type, flow, output_format='parquet', base_path=columnar_dir):
+    path = partition_path(series_type, flow, output_format, base_path)
+    table = to_table(df)
+    with run_state.atomic_path(path) as temp_path:
+        if output_format == 'arrow':
+            # Arrow IPC sem compressão, para ser lido com memory map
+            feather.write_feather(table, temp_path, compression='uncompressed')
+        else:
+            pq.write_table(table, temp_path)
+    return path
+
+def load_frame(series_type, flow, output_format='parquet', base_path=columnar_dir):
+    path = partition_path(series_type, flow, output_format, base_path)
+    if output_format == 'arrow':
+        return feather.read_table(path, memory_map=True).to_pandas()
+    return pq.read_table(path, memory_map=True).to_pandas()
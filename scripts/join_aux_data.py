@@ -1,74 +1,163 @@
 import pandas as pd
 import os
-import csv
-
-def merge_auxiliary_tables(input_table_path, output_table_path):
+import sys
+import hashlib
+import pickle
+import numpy as np
+import fact_store
+import aux_tables
+import catalog
+import metrics
+import run_state
+
+# Tabelas auxiliares em data/auxiliar, salvo indicação em contrário
+default_aux_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data/auxiliar')
+
+def merge_auxiliary_tables(input_table_path, output_table_path, aux_path=None):
     # Carrega o DataFrame final
     final_df = pd.read_csv(input_table_path)
 
-    # Garante que CO_ANO e CO_MES sejam strings e concatena para formar DATA
-    final_df['DATA'] = final_df['CO_ANO'].astype(str) + '-' + final_df['CO_MES'].astype(str) + '-01'
-
-    # Descarta CO_ANO e CO_MES após o cálculo de DATA
-    final_df.drop(['CO_ANO', 'CO_MES'], axis=1, inplace=True)
-
-    # Garante que CO_NCM seja do tipo string antes de mapear
-    final_df['CO_NCM'] = final_df['CO_NCM'].astype(str)
-
-    # Define o caminho base para as tabelas auxiliares
-    base_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data/auxiliar')
-
-    # Fusão AUX 10
-    aux10_df = pd.read_csv(os.path.join(base_path, 'aux_10.csv'), index_col='CO_PAIS')
-    final_df = pd.merge(final_df, aux10_df[['CO_PAIS_ISOA3']], on='CO_PAIS', how='left')
-
-    # Fusão AUX 14
-    aux14_df = pd.read_csv(os.path.join(base_path, 'aux_14.csv'), index_col='CO_VIA')
-    final_df = pd.merge(final_df, aux14_df[['NO_VIA']], on='CO_VIA', how='left')
-
-    # Fusão AUX 15
-    aux15_df = pd.read_csv(os.path.join(base_path, 'aux_15.csv'), index_col='CO_URF')
-    final_df = pd.merge(final_df, aux15_df[['NO_URF']], on='CO_URF', how='left')
-
-    # Substitui CO_NCM por COD_COMM usando o arquivo cod_comms.csv
-    cod_mapping_path = os.path.join(base_path, 'cod_comms.csv')
-    with open(cod_mapping_path, 'r') as file:
-        reader = csv.reader(file)
-        cod_mapping = {row[0]: row[1] for row in reader}
-    final_df['COD_COMM'] = final_df['CO_NCM'].map(cod_mapping)
-    final_df.drop('CO_NCM', axis=1, inplace=True)
-
-    # Substitui NO_URF por COD_URF usando o arquivo cod_portos.csv
-    cod_urf_mapping_path = os.path.join(base_path, 'cod_portos.csv')
-    cod_urf_mapping = pd.read_csv(cod_urf_mapping_path)
-    final_df = pd.merge(final_df, cod_urf_mapping, on='NO_URF', how='left')
-    final_df.drop('NO_URF', axis=1, inplace=True)
-
-    # Descarta colunas especificadas
-    final_df.drop(['CO_UNID', 'CO_PAIS', 'CO_VIA', 'CO_URF', 'QT_ESTAT', 'NO_VIA'], axis=1, inplace=True)
-
-    # Renomeia colunas com base no arquivo
-    if 'EXP' in output_table_path:
-        final_df.rename(columns={'KG_LIQUIDO': 'KGL', 'VL_FOB': 'FOB'}, inplace=True)
-    elif 'IMP' in output_table_path:
-        final_df.rename(columns={'KG_LIQUIDO': 'KGL', 'VL_FOB': 'FOB', 'VL_FRETE': 'VLF', 'VL_SEGURO': 'VLS'}, inplace=True)
-
-    # Reordena as colunas
-    value_columns = [col for col in final_df.columns if col not in ['DATA', 'COD_COMM', 'SG_UF_NCM', 'CO_PAIS_ISOA3', 'COD_URF']]
-    final_df = final_df[['DATA', 'COD_COMM', 'SG_UF_NCM', 'CO_PAIS_ISOA3', 'COD_URF'] + value_columns]
+    # Mescla com as tabelas auxiliares, usando o fluxo indicado no nome do arquivo
+    final_df = join_frame(final_df, 'EXP' if 'EXP' in output_table_path else 'IMP', aux_path)
 
     # Salva o DataFrame final
-    final_df.to_csv(output_table_path, index=False)
+    with run_state.atomic_path(output_table_path) as temp_path:
+        final_df.to_csv(temp_path, index=False)
     print(f"Dados mesclados salvos em {output_table_path}")
 
+def join_incremental(final_df, data_type, aux_path=None):
+    # Identifica os meses novos ou revisados no DataFrame final, ou todos se as tabelas auxiliares mudaram
+    base_path = aux_path or default_aux_path
+    changes = fact_store.changed_months(final_df, data_type, lookups_digest(base_path))
+
+    if changes:
+        # Mescla apenas as linhas dos meses alterados e grava as partições correspondentes
+        months = {tuple(int(part) for part in key.split('-')) for key in changes}
+        month_mask = pd.Series(list(zip(final_df['CO_ANO'], final_df['CO_MES'])), index=final_df.index).isin(months)
+        fact_store.write_months(join_frame(final_df[month_mask], data_type, base_path), data_type, changes)
+        print(f"Meses atualizados no repositório local para {data_type}: {', '.join(sorted(changes))}")
+    else:
+        print(f"Nenhum mês novo ou revisado para {data_type}.")
+
+    # Reconstrói os dados processados completos a partir do repositório local
+    return fact_store.load_facts(data_type), fact_store.pending_changes(data_type, changes)
+
+def lookups_digest(base_path):
+    # Digest dos arquivos de origem das tabelas de consulta (AUX 10, AUX 15, catálogo e cod_portos.csv)
+    sources = [aux_tables.table_path('10', base_path), aux_tables.table_path('15', base_path), catalog.catalog_path(base_path), os.path.join(base_path, 'cod_portos.csv')]
+    digest = hashlib.sha1()
+    for path in sources:
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def compile_lookups(base_path):
+    # Compila as tabelas auxiliares em pares (chaves inteiras, códigos de categoria) + categorias,
+    # reutilizando o resultado em cache enquanto os arquivos de origem não mudarem
+    digest = lookups_digest(base_path)
+    cache_path = os.path.join(base_path, 'cache', 'lookups.pkl')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as file:
+            cached = pickle.load(file)
+        if cached['digest'] == digest:
+            return cached['lookups']
+
+    # CO_PAIS -> CO_PAIS_ISOA3 (AUX 10)
+    aux10_df = aux_tables.load_table('10', base_path)
+    pais = aux10_df.drop_duplicates('CO_PAIS')
+    # CO_URF -> NO_URF (AUX 15) -> COD_URF (cod_portos.csv), resolvido de uma vez
+    aux15_df = aux_tables.load_table('15', base_path).drop_duplicates('CO_URF')
+    cod_urf_mapping = pd.read_csv(os.path.join(base_path, 'cod_portos.csv')).drop_duplicates('NO_URF')
+    urf = aux15_df.merge(cod_urf_mapping, on='NO_URF', how='left')
+
+    lookups = {
+        'CO_PAIS_ISOA3': encode_lookup(pais['CO_PAIS'], pais['CO_PAIS_ISOA3']),
+        'COD_URF': encode_lookup(urf['CO_URF'], urf['COD_URF']),
+        # CO_NCM -> COD_COMM, compilada a partir do catálogo de commodities
+        'COD_COMM': catalog.commodity_lookup(base_path),
+    }
+    with run_state.atomic_path(cache_path) as temp_path:
+        with open(temp_path, 'wb') as file:
+            pickle.dump({'digest': digest, 'lookups': lookups}, file)
+    return lookups
+
+def encode_lookup(keys, values):
+    # Chaves inteiras ordenadas e o código de categoria (-1 para ausente) de cada chave
+    codes, categories = pd.factorize(values.astype(object).where(values.notna(), None))
+    order = np.argsort(keys.to_numpy(dtype='int64'), kind='stable')
+    return keys.to_numpy(dtype='int64')[order], codes[order], pd.Index(categories, dtype=object)
+
+def resolve(lookup, values):
+    # Resolve um vetor de chaves inteiras em um Categorical, via índice e take vetorizados
+    keys, codes, categories = lookup
+    positions = pd.Index(keys).get_indexer(values)
+    row_codes = np.where(positions >= 0, codes.take(positions), -1)
+    return pd.Categorical.from_codes(row_codes, categories=categories)
+
+def build_dates(years, months):
+    # Monta DATA como categórica a partir dos pares (ano, mês) distintos
+    codes, uniques = pd.factorize(years.to_numpy(dtype='int64') * 100 + months.to_numpy(dtype='int64'))
+    categories = [f"{value // 100}-{value % 100}-01" for value in uniques]
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+def join_frame(final_df, data_type, aux_path=None):
+    # Define o caminho base para as tabelas auxiliares (data/auxiliar, salvo indicação em contrário)
+    base_path = aux_path or default_aux_path
+    with metrics.stage('join.compile_lookups'):
+        lookups = compile_lookups(base_path)
+
+    # Colunas-chave categóricas, resolvidas pelas tabelas auxiliares compiladas
+    key_columns = {
+        'DATA': build_dates(final_df['CO_ANO'], final_df['CO_MES']),
+        'COD_COMM': resolve(lookups['COD_COMM'], final_df['CO_NCM'].to_numpy()),
+        'SG_UF_NCM': final_df['SG_UF_NCM'].to_numpy(),
+        'CO_PAIS_ISOA3': resolve(lookups['CO_PAIS_ISOA3'], final_df['CO_PAIS'].to_numpy()),
+        'COD_URF': resolve(lookups['COD_URF'], final_df['CO_URF'].to_numpy()),
+    }
+
+    # Renomeia colunas de valores com base no fluxo
+    if data_type == 'EXP':
+        renames = {'KG_LIQUIDO': 'KGL', 'VL_FOB': 'FOB'}
+    else:
+        renames = {'KG_LIQUIDO': 'KGL', 'VL_FOB': 'FOB', 'VL_FRETE': 'VLF', 'VL_SEGURO': 'VLS'}
+
+    # Descarta colunas de códigos já resolvidos e mantém as demais colunas de valores na ordem original
+    dropped = ['CO_ANO', 'CO_MES', 'CO_NCM', 'CO_UNID', 'CO_PAIS', 'SG_UF_NCM', 'CO_VIA', 'CO_URF', 'QT_ESTAT']
+    value_columns = {renames.get(col, col): final_df[col].to_numpy() for col in final_df.columns if col not in dropped}
+    return pd.DataFrame({**key_columns, **value_columns}, index=pd.RangeIndex(len(final_df)))
+
 # Define o caminho base para as pastas de dados brutos e processados
 base_path = os.path.dirname(os.path.abspath(__file__))
 raw_path = os.path.join(base_path, os.pardir, 'data/raw')
 processed_path = os.path.join(base_path, os.pardir, 'data/processed')
 
-# Garante que a pasta processada exista
-os.makedirs(processed_path, exist_ok=True)
-
-# Chama a função para as tabelas finais EXP e IMP
-merge_auxiliary_tables(os.path.join(raw_path, 'EXP_final.csv'), os.path.join(processed_path, 'EXP_final_processed.csv'))
-merge_auxiliary_tables(os.path.join(raw_path, 'IMP_final.csv'), os.path.join(processed_path, 'IMP_final_processed.csv'))
+def run(raw_frames=None, incremental=False, checkpoint=True):
+    # Etapa de junção: recebe os DataFrames brutos (ou lê data/raw) e devolve os dados processados
+    # por fluxo e os meses alterados; com checkpoint, grava também os CSVs em data/processed
+    processed = {}
+    changes = {}
+    for data_type in ('EXP', 'IMP'):
+        with metrics.stage(f'join.{data_type}'):
+            final_df = raw_frames[data_type] if raw_frames is not None else pd.read_csv(os.path.join(raw_path, f'{data_type}_final.csv'))
+            if incremental:
+                # Modo incremental: mescla apenas os meses alterados
+                processed[data_type], changes[data_type] = join_incremental(final_df, data_type)
+                metrics.record(f'join.{data_type}', 'months_changed', len(changes[data_type]))
+            else:
+                processed[data_type] = join_frame(final_df, data_type)
+            metrics.record(f'join.{data_type}', 'rows_in', len(final_df))
+            metrics.record(f'join.{data_type}', 'rows_out', len(processed[data_type]))
+        if checkpoint:
+            # Garante que a pasta processada exista
+            os.makedirs(processed_path, exist_ok=True)
+            output_table_path = os.path.join(processed_path, f'{data_type}_final_processed.csv')
+            with run_state.atomic_path(output_table_path) as temp_path:
+                processed[data_type].to_csv(temp_path, index=False)
+            print(f"Dados mesclados salvos em {output_table_path}")
+    if incremental:
+        # Registra os meses alterados para a geração de IPVs
+        fact_store.save_changes(changes)
+    return processed, changes
+
+if __name__ == '__main__':
+    run(incremental='--incremental' in sys.argv)
@@ -0,0 +1,121 @@
+import contextlib
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+import uuid
+import run_state
+
+# Métricas estruturadas da execução: duração, pico de memória e contadores por etapa e sub-etapa.
+# As etapas registram sempre no coletor do módulo; o registro só é gravado por finish_run
+script_dir = os.path.abspath(os.path.dirname(__file__))
+metrics_path = os.path.join(script_dir, '..', 'data', 'logs', 'metrics.jsonl')
+prometheus_path = os.path.join(script_dir, '..', 'data', 'logs', 'metrics.prom')
+
+current_run = {}
+
+# Métricas de memória por etapa: combinadas pelo maior valor, e não somadas, entre processos
+MAX_METRICS = ('peak_rss_increase_bytes', 'rss_bytes')
+
+def start_run():
+    current_run.clear()
+    current_run.update({
+        'run_id': uuid.uuid4().hex,
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'start_time': time.time(),
+        'stages': {},
+    })
+    return current_run
+
+def stage_entry(name):
+    return current_run.setdefault('stages', {}).setdefault(name, {})
+
+def peak_rss_bytes():
+    # ru_maxrss é o pico do processo até o momento: KB no Linux, bytes no macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def current_rss_bytes():
+    # RSS atual do processo (Linux, via /proc); None onde não estiver disponível
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+@contextlib.contextmanager
+def stage(name):
+    # Mede a duração da etapa, quanto ela elevou o pico de memória do processo (o ru_maxrss só cresce,
+    # então o pico absoluto refletiria as etapas anteriores) e o RSS atual ao final dela
+    start_time = time.time()
+    start_peak = peak_rss_bytes()
+    try:
+        yield stage_entry(name)
+    finally:
+        entry = stage_entry(name)
+        entry['duration_seconds'] = round(entry.get('duration_seconds', 0) + time.time() - start_time, 6)
+        entry['peak_rss_increase_bytes'] = max(entry.get('peak_rss_increase_bytes', 0), peak_rss_bytes() - start_peak)
+        rss = current_rss_bytes()
+        if rss is not None:
+            entry['rss_bytes'] = rss
+
+def increment(name, metric, value=1):
+    entry = stage_entry(name)
+    entry[metric] = entry.get(metric, 0) + value
+
+def record(name, metric, value):
+    stage_entry(name)[metric] = value
+
+def merge_stages(stages):
+    # Incorpora as métricas registradas em outro processo (ex.: workers da geração de IPVs):
+    # durações e contadores são somados, as métricas de memória ficam com o maior valor
+    for name, entry in stages.items():
+        target = stage_entry(name)
+        for metric, value in entry.items():
+            if metric in MAX_METRICS:
+                target[metric] = max(target.get(metric, 0), value)
+            else:
+                target[metric] = round(target.get(metric, 0) + value, 6)
+
+def finish_run(status='success', prometheus=False):
+    # Completa o registro (throughput dos downloads e totais) e o anexa ao arquivo JSON-lines
+    run = {key: value for key, value in current_run.items() if key != 'start_time'}
+    run['finished_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+    run['duration_seconds'] = round(time.time() - current_run.get('start_time', time.time()), 6)
+    run['status'] = status
+    run['peak_rss_bytes'] = peak_rss_bytes()
+    for entry in run.get('stages', {}).values():
+        # Só o tempo de leitura do corpo das respostas, sem a espera pelo semáforo nem as re-tentativas
+        if entry.get('download_bytes') and entry.get('transfer_seconds'):
+            entry['throughput_bytes_per_second'] = round(entry['download_bytes'] / entry['transfer_seconds'], 2)
+    os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+    with open(metrics_path, 'a') as file:
+        file.write(json.dumps(run, sort_keys=True) + '\n')
+    if prometheus:
+        write_prometheus(run)
+    return run
+
+def write_prometheus(run):
+    # Exporta o último registro no formato texto do Prometheus (para o textfile collector do node_exporter)
+    samples = {}
+    for stage_name, entry in sorted(run.get('stages', {}).items()):
+        for metric, value in sorted(entry.items()):
+            if isinstance(value, (int, float)):
+                samples.setdefault(f"comex_stage_{metric}", []).append(f'comex_stage_{metric}{{stage="{stage_name}"}} {value}')
+    lines = [
+        '# TYPE comex_run_duration_seconds gauge',
+        f'comex_run_duration_seconds {run["duration_seconds"]}',
+        '# TYPE comex_run_peak_rss_bytes gauge',
+        f'comex_run_peak_rss_bytes {run["peak_rss_bytes"]}',
+        '# TYPE comex_run_success gauge',
+        f'comex_run_success {1 if run["status"] == "success" else 0}',
+    ]
+    for name, metric_samples in samples.items():
+        lines.append(f'# TYPE {name} gauge')
+        lines.extend(metric_samples)
+    # Publicado com rename atômico, como pede o textfile collector
+    with run_state.atomic_path(prometheus_path) as temp_path:
+        with open(temp_path, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+import time
+import pandas as pd
+
+# Permite importar as etapas como módulos, tanto a partir de main.py quanto de scripts/
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fact_store
+import fetch_data
+import join_aux_data
+import generate_ipvs
+import metrics
+import run_state
+
+def run_fetch(options):
+    # Coleta: devolve {'EXP': DataFrame, 'IMP': DataFrame} com as linhas filtradas
+    if options.get('backfill'):
+        start_year, end_year = options['backfill']
+        return asyncio.run(fetch_data.backfill(start_year, end_year, options.get('concurrency'), options.get('workers'), checkpoint=options.get('checkpoint', False)))
+    return asyncio.run(fetch_data.main(options.get('concurrency') or fetch_data.DEFAULT_CONCURRENCY, checkpoint=options.get('checkpoint', False)))
+
+def run_join(options, raw_frames):
+    # Junção: devolve (dados processados por fluxo, meses alterados por fluxo)
+    return join_aux_data.run(raw_frames, incremental=options.get('incremental', False), checkpoint=options.get('checkpoint', False))
+
+def run_generate(options, joined):
+    # Geração: devolve os caminhos dos arquivos IPV publicados
+    processed, changes = joined
+    return generate_ipvs.main(incremental=options.get('incremental', False), exp_data=processed['EXP'], imp_data=processed['IMP'], changes=changes, columnar=options.get('columnar'), parallel=options.get('parallel', False))
+
+def save_frames(name, frames):
+    # Grava os DataFrames de uma etapa (um Parquet por fluxo) quando eles não estão em disco
+    paths = []
+    for data_type, df in frames.items():
+        if df is None:
+            continue
+        path = os.path.join(run_state.stage_dir(name), f"{data_type}.parquet")
+        with run_state.atomic_path(path) as temp_path:
+            df.to_parquet(temp_path, index=False)
+        paths.append(path)
+    return paths
+
+def load_frames(name):
+    frames = {}
+    for data_type in ('EXP', 'IMP'):
+        path = os.path.join(run_state.stage_dir(name), f"{data_type}.parquet")
+        frames[data_type] = pd.read_parquet(path) if os.path.exists(path) else None
+    return frames
+
+def save_fetch(options, raw_frames):
+    # As linhas filtradas de cada arquivo anual já estão em disco, nos artefatos Parquet do cache HTTP:
+    # registra apenas a lista de artefatos por fluxo, sem gravar os dados de novo
+    sources = {data_type: df.attrs.get('sources') for data_type, df in raw_frames.items() if df is not None}
+    if not all(sources.values()):
+        return save_frames('fetch', raw_frames)
+    sources_path = os.path.join(run_state.stage_dir('fetch'), 'sources.json')
+    run_state.write_json(sources, sources_path, indent=2)
+    return [sources_path] + [path for paths in sources.values() for path in paths]
+
+def load_fetch(options):
+    sources_path = os.path.join(run_state.stage_dir('fetch'), 'sources.json')
+    if not os.path.exists(sources_path):
+        return load_frames('fetch')
+    with open(sources_path, 'r') as file:
+        sources = json.load(file)
+    return {data_type: pd.concat([pd.read_parquet(path) for path in sources[data_type]], ignore_index=True) if data_type in sources else None for data_type in ('EXP', 'IMP')}
+
+def save_join(options, joined):
+    # No modo incremental, os dados processados são as partições do repositório local de fatos.
+    # Sem ele, a junção não é registrada e, na retomada, é refeita a partir das saídas da coleta
+    if not options.get('incremental'):
+        return None
+    _, changes = joined
+    changes_path = os.path.join(run_state.stage_dir('join'), 'changes.json')
+    run_state.write_json(changes, changes_path, indent=2, sort_keys=True)
+    return [changes_path] + fact_store.partition_paths('EXP') + fact_store.partition_paths('IMP')
+
+def load_join(options):
+    with open(os.path.join(run_state.stage_dir('join'), 'changes.json'), 'r') as file:
+        changes = json.load(file)
+    return {data_type: fact_store.load_facts(data_type) for data_type in ('EXP', 'IMP')}, changes
+
+def save_generate(options, published):
+    return published
+
+# Grafo de etapas: nome -> (dependências, função, registro das saídas, leitura das saídas).
+# Os resultados passam de uma etapa para a outra em memória. Cada etapa, assim que termina, registra
+# no manifesto da execução (data/runs) as saídas que já estão em disco, para que uma nova tentativa
+# retome a partir delas mesmo após uma interrupção abrupta (kill, falta de memória, reinício).
+# Os checkpoints em data/raw e data/processed só são gravados com checkpoint=True
+STAGES = {
+    'fetch': ([], run_fetch, save_fetch, load_fetch),
+    'join': (['fetch'], run_join, save_join, load_join),
+    'generate': (['join'], run_generate, save_generate, None),
+}
+
+def stage_order(stages=STAGES):
+    # Ordenação topológica das etapas
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependência circular na etapa {name}.")
+        visiting.add(name)
+        for dependency in stages[name][0]:
+            visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+def run_pipeline(incremental=False, backfill=None, checkpoint=False, concurrency=None, columnar=None, resume=True, parallel=False, workers=None, target=None):
+    # concurrency e workers só afetam a coleta: None usa os padrões de fetch_data (no backfill, todos os núcleos).
+    # target identifica o mês de atualização procurado, para não retomar uma execução de outra atualização
+    options = {'incremental': incremental, 'backfill': backfill, 'checkpoint': checkpoint, 'concurrency': concurrency, 'columnar': columnar, 'parallel': parallel, 'workers': workers, 'target': target}
+    results = {}
+
+    def result(name):
+        # Resultado de uma etapa concluída em uma tentativa anterior, lido das saídas registradas
+        if name not in results:
+            results[name] = STAGES[name][3](options)
+        return results[name]
+
+    with run_state.pipeline_lock():
+        # Com resume, uma execução interrompida com as mesmas opções retoma após a última etapa concluída
+        manifest = run_state.start({key: value for key, value in options.items() if key not in ('concurrency', 'parallel', 'workers')}, resume)
+        executed = set()
+        for name in stage_order():
+            dependencies, function, save, _ = STAGES[name]
+            if not executed.intersection(dependencies) and run_state.completed(manifest, name):
+                print(f"Etapa {name} já concluída, retomando a partir das saídas registradas.")
+                continue
+            start_time = time.time()
+            with metrics.stage(name):
+                results[name] = function(options, *[result(dependency) for dependency in dependencies])
+                outputs = save(options, results[name])
+                if outputs is not None:
+                    run_state.complete_stage(manifest, name, outputs)
+            executed.add(name)
+            print(f"Etapa {name} concluída em {time.time() - start_time:.2f} segundos.")
+        run_state.finish(manifest)
+        # As saídas intermediárias só servem para retomar uma execução incompleta
+        shutil.rmtree(os.path.join(run_state.runs_dir, 'stages'), ignore_errors=True)
+    return results
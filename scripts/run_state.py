@@ -0,0 +1,100 @@
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import uuid
+
+# Publicação atômica das saídas e manifesto da execução, que permite retomar a pipeline a partir
+# da última etapa concluída. Cada etapa concluída registra suas saídas com o hash do conteúdo
+script_dir = os.path.abspath(os.path.dirname(__file__))
+runs_dir = os.path.normpath(os.path.join(script_dir, '..', 'data', 'runs'))
+manifest_path = os.path.join(runs_dir, 'manifest.json')
+lock_path = os.path.join(runs_dir, 'pipeline.lock')
+
+@contextlib.contextmanager
+def atomic_path(path):
+    # Grava em um arquivo temporário no mesmo diretório e o publica com os.replace: leitores veem
+    # o arquivo anterior ou o novo completo, nunca um arquivo parcial
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def write_json(data, path, **kwargs):
+    with atomic_path(path) as temp_path:
+        with open(temp_path, 'w') as file:
+            json.dump(data, file, **kwargs)
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+@contextlib.contextmanager
+def pipeline_lock():
+    # Impede duas execuções simultâneas da pipeline sobre o mesmo diretório de dados
+    os.makedirs(runs_dir, exist_ok=True)
+    with open(lock_path, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError("Outra execução da pipeline está em andamento.")
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def run_key(options):
+    # Identifica a execução pelas opções (incluindo o mês de atualização procurado): uma nova tentativa
+    # retoma a anterior mesmo em outro dia, e as saídas registradas só são reaproveitadas se o hash conferir
+    return json.dumps(options, sort_keys=True)
+
+def stage_dir(name):
+    return os.path.join(runs_dir, 'stages', name)
+
+def load_manifest():
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+def save_manifest(manifest):
+    write_json(manifest, manifest_path, indent=2, sort_keys=True)
+
+def start(options, resume=True):
+    # Retoma o manifesto de uma execução incompleta com as mesmas opções, ou inicia um novo
+    manifest = load_manifest()
+    key = run_key(options)
+    if resume and manifest.get('key') == key and manifest.get('status') != 'complete':
+        return manifest
+    manifest = {'key': key, 'status': 'running', 'started_at': datetime.datetime.now().isoformat(timespec='seconds'), 'stages': {}}
+    save_manifest(manifest)
+    return manifest
+
+def completed(manifest, name):
+    # A etapa está concluída se foi registrada e todas as saídas existem com o mesmo conteúdo
+    entry = manifest.get('stages', {}).get(name)
+    if not entry:
+        return False
+    return all(os.path.exists(path) and file_hash(path) == digest for path, digest in entry['outputs'].items())
+
+def complete_stage(manifest, name, paths):
+    manifest['stages'][name] = {
+        'completed_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'outputs': {path: file_hash(path) for path in paths},
+    }
+    save_manifest(manifest)
+
+def finish(manifest):
+    manifest['status'] = 'complete'
+    manifest['finished_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+    save_manifest(manifest)
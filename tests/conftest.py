@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Os scripts importam uns aos outros pelo nome, como quando executados a partir de scripts/
+tests_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(tests_dir, os.pardir))
+sys.path.insert(0, os.path.join(tests_dir, os.pardir, 'scripts'))
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+import fact_store
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(fact_store, 'store_dir', str(tmp_path))
+    monkeypatch.setattr(fact_store, 'manifest_path', str(tmp_path / 'manifest.json'))
+    monkeypatch.setattr(fact_store, 'changes_path', str(tmp_path / 'changes.json'))
+
+def raw_frame(months, value=1):
+    return pd.DataFrame({
+        'CO_ANO': [2024] * len(months),
+        'CO_MES': months,
+        'CO_NCM': [1201] * len(months),
+        'VL_FOB': [value] * len(months),
+    })
+
+def processed_frame(months):
+    return pd.DataFrame({'DATA': [f"2024-{month}-01" for month in months], 'FOB': [1] * len(months)})
+
+def test_changed_months_after_write():
+    changes = fact_store.changed_months(raw_frame([1, 2]), 'EXP', 'digest')
+    assert sorted(changes) == ['2024-01', '2024-02']
+    fact_store.write_months(processed_frame([1, 2]), 'EXP', changes)
+    assert fact_store.changed_months(raw_frame([1, 2]), 'EXP', 'digest') == {}
+    # Revisão de um mês
+    revised = pd.concat([raw_frame([1]), raw_frame([2], value=2)], ignore_index=True)
+    assert list(fact_store.changed_months(revised, 'EXP', 'digest')) == ['2024-02']
+    assert len(fact_store.load_facts('EXP')) == 2
+
+def test_lookups_digest_invalidates_all_months():
+    changes = fact_store.changed_months(raw_frame([1, 2]), 'EXP', 'digest')
+    fact_store.write_months(processed_frame([1, 2]), 'EXP', changes)
+    assert sorted(fact_store.changed_months(raw_frame([1, 2]), 'EXP', 'other')) == ['2024-01', '2024-02']
+
+def test_pending_changes_until_cleared():
+    changes = fact_store.changed_months(raw_frame([1]), 'EXP', 'digest')
+    fact_store.write_months(processed_frame([1]), 'EXP', changes)
+    fact_store.save_changes({'EXP': fact_store.pending_changes('EXP', changes)})
+    # Geração de IPVs interrompida: o mês continua pendente na execução seguinte
+    assert fact_store.changed_months(raw_frame([1]), 'EXP', 'digest') == {}
+    assert fact_store.pending_changes('EXP', []) == ['2024-01']
+    fact_store.clear_changes()
+    assert fact_store.pending_changes('EXP', []) == []
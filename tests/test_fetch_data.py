@@ -0,0 +1,39 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import fetch_data
+
+NCM = fetch_data.NCM_CODES[0]
+
+class FakeContent:
+    def __init__(self, body):
+        self.body = body
+
+    async def iter_chunked(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            await asyncio.sleep(0)
+            yield self.body[start:start + chunk_size]
+
+class FakeResponse:
+    def __init__(self, body):
+        self.content = FakeContent(body)
+
+def csv_body(rows):
+    lines = ['"CO_ANO";"CO_MES";"CO_NCM";"VL_FOB"']
+    lines += [f'"2024";"{row % 12 + 1:02d}";"{NCM if row % 3 else "00000000"}";"{row}"' for row in range(rows)]
+    return ('\n'.join(lines) + '\n').encode('latin1')
+
+def run_filter(body, chunk_size, executor=None, max_pending=2):
+    handler = fetch_data.make_stream_filter(fetch_data.NCM_CODES, chunk_size, executor, max_pending=max_pending)
+    return asyncio.run(handler(FakeResponse(body)))
+
+def test_stream_filter_keeps_matching_rows():
+    df = run_filter(csv_body(30), chunk_size=64)
+    assert list(df['VL_FOB']) == [row for row in range(30) if row % 3]
+
+def test_pooled_filter_preserves_block_order():
+    # Vários blocos em filtragem ao mesmo tempo: o resultado segue a ordem do arquivo
+    body = csv_body(500)
+    expected = run_filter(body, chunk_size=1 << 20)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for max_pending in (1, 4, 16):
+            assert run_filter(body, chunk_size=128, executor=executor, max_pending=max_pending).equals(expected)
@@ -0,0 +1,155 @@
+import asyncio
+import http.server
+import json
+import threading
+import pytest
+import fetch_data
+import http_cache
+import main
+
+NCM = fetch_data.NCM_CODES[0]
+HEADER = '"CO_ANO";"CO_MES";"CO_NCM";"CO_UNID";"CO_PAIS";"SG_UF_NCM";"CO_VIA";"CO_URF";"QT_ESTAT";"KG_LIQUIDO";"VL_FOB"'
+
+def csv_body(months, ncm=NCM):
+    lines = [HEADER] + [f'"2024";"{month:02d}";"{ncm}";"10";"40";"SP";"01";"0817600";"1";"10";"20"' for month in months]
+    # Linha de um NCM fora do catálogo, descartada pelo filtro
+    lines.append('"2024";"01";"00000000";"10";"40";"SP";"01";"0817600";"1";"10";"20"')
+    return ('\n'.join(lines) + '\n').encode('latin1')
+
+class StubServer:
+    # Servidor HTTP local com ETag, respostas 304 (If-None-Match) e Range de sufixo (bytes=-N)
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self.respond(send_body=False)
+
+            def do_GET(self):
+                self.respond(send_body=True)
+
+            def respond(self, send_body):
+                stub.requests.append((self.command, self.path, dict(self.headers)))
+                if self.path not in stub.files:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body, etag = stub.files[self.path]
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                status, content_range = 200, None
+                range_header = self.headers.get('Range', '')
+                if send_body and range_header.startswith('bytes=-'):
+                    start = max(len(body) - int(range_header[len('bytes=-'):]), 0)
+                    status, content_range = 206, f"bytes {start}-{len(body) - 1}/{len(body)}"
+                    body = body[start:]
+                self.send_response(status)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                if content_range:
+                    self.send_header('Content-Range', content_range)
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def requests_by_method(self, method):
+        return [request for request in self.requests if request[0] == method]
+
+@pytest.fixture
+def server():
+    stub = StubServer()
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(http_cache, 'cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(http_cache, 'index_path', str(tmp_path / 'cache' / 'index.json'))
+    (tmp_path / 'data' / 'logs').mkdir(parents=True)
+    return tmp_path
+
+def fetch(server, year='2024', ncm_codes=fetch_data.NCM_CODES):
+    async def run():
+        async with fetch_data.create_session() as session:
+            return await fetch_data.fetch_year(session, asyncio.Semaphore(1), year, ncm_codes, 'EXP', server.base_url)
+    return asyncio.run(run())
+
+def write_update_log(year, month):
+    update_log = {'LAST_UPDATED': {'MONTH': str(month), 'YEAR': str(year)}}
+    with open('data/logs/update_log.json', 'w') as file:
+        json.dump(update_log, file)
+
+def test_download_records_cache_entry(server):
+    server.files['/EXP_2024.csv'] = (csv_body([1, 2]), '"v1"')
+    df = fetch(server)
+    assert list(df['CO_MES']) == [1, 2]
+    entry = http_cache.get_entry(f"{server.base_url}EXP_2024.csv", fetch_data.filtered_suffix(fetch_data.NCM_CODES))
+    assert entry['etag'] == '"v1"'
+    assert entry['size'] == len(csv_body([1, 2]))
+
+def test_not_modified_reuses_cached_artifact(server):
+    server.files['/EXP_2024.csv'] = (csv_body([1, 2]), '"v1"')
+    first = fetch(server)
+    second = fetch(server)
+    # A segunda requisição é condicional e o resultado filtrado vem do cache
+    assert server.requests[-1][2].get('If-None-Match') == '"v1"'
+    assert second.equals(first)
+
+def test_etag_change_refetches(server):
+    server.files['/EXP_2024.csv'] = (csv_body([1]), '"v1"')
+    fetch(server)
+    server.files['/EXP_2024.csv'] = (csv_body([1, 2, 3]), '"v2"')
+    df = fetch(server)
+    assert list(df['CO_MES']) == [1, 2, 3]
+    assert http_cache.get_entry(f"{server.base_url}EXP_2024.csv", fetch_data.filtered_suffix(fetch_data.NCM_CODES))['etag'] == '"v2"'
+
+def test_validators_are_kept_per_artifact(server):
+    server.files['/EXP_2024.csv'] = (csv_body([1]), '"v1"')
+    fetch(server)
+    # Arquivo republicado e baixado com outro conjunto de NCMs (outro artefato da mesma URL)
+    server.files['/EXP_2024.csv'] = (csv_body([1, 2, 3]), '"v2"')
+    fetch(server, ncm_codes=fetch_data.NCM_CODES[1:])
+    # O artefato com o conjunto completo ainda vem da versão "v1" e não pode ser reaproveitado
+    df = fetch(server)
+    assert server.requests[-1][2].get('If-None-Match') == '"v1"'
+    assert list(df['CO_MES']) == [1, 2, 3]
+
+def test_head_short_circuit_requires_completed_run(server, monkeypatch):
+    monkeypatch.setattr(main, 'BASE_URL', server.base_url)
+    server.files['/EXP_2024.csv'] = (csv_body([1, 2, 3, 4]), '"v1"')
+    write_update_log(2024, 3)
+    # Download registrado no cache HTTP por uma execução que não atualizou o log
+    fetch(server)
+    assert main.check_data_update()
+    assert server.requests_by_method('GET')[-1][2].get('Range') == f"bytes=-{main.PROBE_TAIL_BYTES}"
+
+    # Execução concluída em maio: o log registra abril e os validadores do arquivo de 2024
+    class May(main.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return main.datetime(2024, 5, 10)
+    monkeypatch.setattr(main, 'datetime', May)
+    main.update_log_file()
+    requests_before = len(server.requests)
+    assert not main.check_data_update()
+    assert [request[0] for request in server.requests[requests_before:]] == ['HEAD']
+
+    # Arquivo republicado: a verificação volta a ler o final do arquivo
+    server.files['/EXP_2024.csv'] = (csv_body([1, 2, 3, 4, 5]), '"v2"')
+    assert main.check_data_update()
+    assert [request[0] for request in server.requests[requests_before:]] == ['HEAD', 'HEAD', 'GET']
@@ -0,0 +1,92 @@
+import json
+import os
+import pytest
+import pipeline
+import run_state
+
+@pytest.fixture(autouse=True)
+def runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_state, 'runs_dir', str(tmp_path))
+    monkeypatch.setattr(run_state, 'manifest_path', str(tmp_path / 'manifest.json'))
+    monkeypatch.setattr(run_state, 'lock_path', str(tmp_path / 'pipeline.lock'))
+
+def fake_stages(calls, fail=None, unrecorded=()):
+    # Etapas que registram as chamadas e gravam o resultado em JSON (exceto as de unrecorded)
+    def stage(name):
+        def function(options, *inputs):
+            calls.append(name)
+            if name == fail:
+                raise RuntimeError("falha simulada")
+            return sum(inputs) + 1
+
+        def save(options, result):
+            if name in unrecorded:
+                return None
+            path = os.path.join(run_state.stage_dir(name), 'result.json')
+            run_state.write_json(result, path)
+            return [path]
+
+        def load(options):
+            with open(os.path.join(run_state.stage_dir(name), 'result.json'), 'r') as file:
+                return json.load(file)
+
+        return function, save, load
+
+    return {name: (dependencies, *stage(name)) for name, dependencies in (('fetch', []), ('join', ['fetch']), ('generate', ['join']))}
+
+def test_stages_are_recorded_as_they_complete(monkeypatch):
+    calls = []
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls, fail='generate'))
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline()
+    # Sem tratamento da falha: o registro já foi feito ao fim de cada etapa
+    assert sorted(run_state.load_manifest()['stages']) == ['fetch', 'join']
+
+    calls.clear()
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls))
+    results = pipeline.run_pipeline()
+    assert calls == ['generate']
+    assert results['generate'] == 3
+    assert run_state.load_manifest()['status'] == 'complete'
+    assert not os.path.exists(os.path.join(run_state.runs_dir, 'stages'))
+
+def test_unrecorded_stage_is_rerun_from_its_dependencies(monkeypatch):
+    calls = []
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls, fail='generate', unrecorded=('join',)))
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline()
+    calls.clear()
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls, unrecorded=('join',)))
+    pipeline.run_pipeline()
+    assert calls == ['join', 'generate']
+
+def test_changed_output_invalidates_stage(monkeypatch):
+    calls = []
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls, fail='generate'))
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline()
+    run_state.write_json(5, os.path.join(run_state.stage_dir('join'), 'result.json'))
+    calls.clear()
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls))
+    pipeline.run_pipeline()
+    assert calls == ['join', 'generate']
+
+def test_resume_depends_on_options_and_target(monkeypatch):
+    calls = []
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls, fail='join'))
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline(target='2024-05')
+    calls.clear()
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls))
+    pipeline.run_pipeline(target='2024-06')
+    assert calls == ['fetch', 'join', 'generate']
+
+def test_no_resume_reruns_all_stages(monkeypatch):
+    calls = []
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls, fail='join'))
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline()
+    calls.clear()
+    monkeypatch.setattr(pipeline, 'STAGES', fake_stages(calls))
+    pipeline.run_pipeline(resume=False)
+    assert calls == ['fetch', 'join', 'generate']